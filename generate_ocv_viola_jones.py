@@ -1,9 +1,8 @@
 from math import log2
-from scamp_filter.scamp_filter import generate
+from scamp_filter.scamp_filter import generate_many, PairGenProps
 from scamp_filter.approx import approx
+from scamp_filter.kernel_cache import KernelCache
 from xml_loader import parse_xml
-import pickle
-import os
 import numpy as np
 
 TILE_SIZE = 24
@@ -34,11 +33,15 @@ def generate_centre_goal_for_feature(feature):
     return kernel, scaling
         
 
-def generate_filter_code_for_feature(feature, search_time=2):
-    goal, scaling = generate_centre_goal_for_feature(feature)
+def generate_filter_code_for_features(features, cache, search_time=2):
+    """Compiles the kernels of all the features at once, across all cores"""
+    goals = [generate_centre_goal_for_feature(feature) for feature in features]
+    # the deep approximation gives goals with many atoms per position, search on their counts instead
+    pair_props = PairGenProps(sort_distinct_pos=True, short_distance_first=True, low_scale_first=True, max_sets=True,
+                              exhaustive=False, line=True, generate_all=True, randomize=False, count_goals=True)
 
-    program, program_length, sol_stats = generate(goal, search_time, available_regs=['C', 'D', 'E'], out_format='CSIM', start_reg='A', target_reg='C', verbose=0, approx_depth=20, max_approx_coeffs=1)
-    return program, scaling
+    results = generate_many([goal for goal, _ in goals], search_time, available_regs=['C', 'D', 'E'], out_format='CSIM', start_reg='A', target_reg='C', verbose=0, approx_depth=20, max_approx_coeffs=1, cache=cache, pair_props=pair_props)
+    return [(program, scaling) for (program, _, _, _), (_, scaling) in zip(results, goals)]
 
 
 def generate_threshold_code_for_feature(feature, dpalpha, dnalpha, scaling):
@@ -100,7 +103,7 @@ def find_feature_groups(features):
     return s
 
 
-def generate_program_for_stage(stage, program_store):
+def generate_program_for_stage(stage, cache):
     # compute average alpha ranges
     # up_total_alpha = sum((f.palpha if f.palpha > 0 else f.nalpha) for f in stage.features)
     # down_total_alpha = sum((f.palpha if f.palpha < 0 else f.nalpha) for f in stage.features)
@@ -111,14 +114,10 @@ def generate_program_for_stage(stage, program_store):
 
     groups = find_feature_groups(stage.features)
 
-    for key, features in groups.items():
-        if key in program_store:
-            program, scaling = program_store[key]
-        else:
-            # generate filter code
-            program, scaling = generate_filter_code_for_feature(features[0])
-            program_store[key] = (program, scaling)
+    # generate filter code, kernels compiled in an earlier stage (or run) are taken from the cache
+    codes = generate_filter_code_for_features([features[0] for features in groups.values()], cache)
 
+    for features, (program, scaling) in zip(groups.values(), codes):
         total_program.extend(program)
 
         for feature in features:
@@ -142,20 +141,13 @@ def main():
     # load pretrained model
     stages = parse_xml('haarcascade_frontalface_default.xml')
 
+    cache = KernelCache('pre_ocv_kernels')
+
     # generate core programs
     for i, stage in enumerate(stages):
         print('STAGE %d..' % (i+1))
 
-        if os.path.isfile('pre_ocv_kernels.pkl'):
-            with open('pre_ocv_kernels.pkl', 'rb') as file:
-                program_store = pickle.load(file)
-        else:
-            program_store = {}
-            
-        program = generate_program_for_stage(stage, program_store)
-
-        with open('pre_ocv_kernels.pkl', 'wb') as file:
-            pickle.dump(program_store, file)
+        program = generate_program_for_stage(stage, cache)
 
         with open('ocv_stages/vj_core_ocv_stage_%d.h'%(i+1), 'w') as file:
             file.write('#include "../scamp.h"\n\n')
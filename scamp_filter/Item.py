@@ -1,9 +1,30 @@
+import weakref
+
+
 class Atom:
-    def __init__(self, nr, x, y, neg=False):
-        self.nr = nr
-        self.x = x
-        self.y = y
-        self.neg = neg
+    """An atom ([nr], x, y) of a goal. Atoms are immutable values, they compare and hash by all their fields, and are
+    interned: creating an atom that is alive already returns the existing instance"""
+    __slots__ = ('nr', 'x', 'y', 'neg', '_hash', '__weakref__')
+    _pool = weakref.WeakValueDictionary()
+
+    def __new__(cls, nr, x, y, neg=False):
+        key = (nr, x, y, neg)
+        atom = cls._pool.get(key)
+        if atom is None:
+            atom = object.__new__(cls)
+            object.__setattr__(atom, 'nr', nr)
+            object.__setattr__(atom, 'x', x)
+            object.__setattr__(atom, 'y', y)
+            object.__setattr__(atom, 'neg', neg)
+            object.__setattr__(atom, '_hash', hash(key))
+            cls._pool[key] = atom
+        return atom
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Atom is immutable')
+
+    def __reduce__(self):
+        return Atom, (self.nr, self.x, self.y, self.neg)
 
     def __str__(self):
         return ('-' if self.neg else '') + '([' + str(self.nr) + '] ' + str(self.x) + ' ' + str(self.y) + ')'
@@ -15,18 +36,37 @@ class Atom:
         return self.x, self.y, self.neg
 
     def __eq__(self, other):
-        return self.nr == other.nr and self.x == other.x and self.y == other.y
+        return self is other or (self.nr == other.nr and self.x == other.x and self.y == other.y and
+                                 self.neg == other.neg)
 
     def __hash__(self):
-        return hash((self.nr, self.x, self.y))
+        return self._hash
 
 
 class Item:
-    def __init__(self, scale, x, y, neg=False):
-        self.scale = scale
-        self.x = x
-        self.y = y
-        self.neg = neg
+    """An item (scale, x, y) of a pre goal, the value 2^-scale at (x, y). Items are immutable values, they compare and
+    hash by all their fields, and are interned like atoms"""
+    __slots__ = ('scale', 'x', 'y', 'neg', '_hash', '__weakref__')
+    _pool = weakref.WeakValueDictionary()
+
+    def __new__(cls, scale, x, y, neg=False):
+        key = (scale, x, y, neg)
+        item = cls._pool.get(key)
+        if item is None:
+            item = object.__new__(cls)
+            object.__setattr__(item, 'scale', scale)
+            object.__setattr__(item, 'x', x)
+            object.__setattr__(item, 'y', y)
+            object.__setattr__(item, 'neg', neg)
+            object.__setattr__(item, '_hash', hash(key))
+            cls._pool[key] = item
+        return item
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Item is immutable')
+
+    def __reduce__(self):
+        return Item, (self.scale, self.x, self.y, self.neg)
 
     def __str__(self):
         return ('-' if self.neg else '') + '(' + str(self.scale) + ' ' + str(self.x) + ' ' + str(self.y) + ')'
@@ -35,7 +75,8 @@ class Item:
         return self.__str__()
 
     def __eq__(self, other):
-        return self.x == other.x and self.y == other.y and self.scale == other.scale
+        return self is other or (self.x == other.x and self.y == other.y and self.scale == other.scale and
+                                 self.neg == other.neg)
 
     def __lt__(self, other):
         if self.scale < other.scale:
@@ -52,7 +93,7 @@ class Item:
         return Item(self.scale, self.x, self.y, not self.neg)
 
     def __hash__(self):
-        return hash((self.scale, self.x, self.y, self.neg))
+        return self._hash
 
     def __len__(self):
-        return abs(self.x) + abs(self.y) + abs(self.scale) + self.neg
\ No newline at end of file
+        return abs(self.x) + abs(self.y) + abs(self.scale) + self.neg
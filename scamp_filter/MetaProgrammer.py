@@ -104,7 +104,9 @@ def find_goal_in_reg(reg_state, needle_goal):
     return -1
 
 
-def generate_meta_program(plan):
+def generate_meta_program(plan, outputs=None):
+    """Generates the meta program of a plan. If a list outputs is given, the registers that hold the goals of the last
+    step are appended to it, in the order of the goals"""
     meta_program = []
 
     prev_reg_state = {
@@ -213,4 +215,6 @@ def generate_meta_program(plan):
         new_reg_state[target] = shift_goal
         prev_reg_state = new_reg_state
 
-    return meta_program
\ No newline at end of file
+    if outputs is not None:
+        outputs.extend(find_goal_in_reg(prev_reg_state, goal) for goal in plan[-1].goals)
+    return meta_program
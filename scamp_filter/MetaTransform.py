@@ -1,12 +1,8 @@
 from .MetaProgrammer import AddMetaInstruction, MoveMetaIntstruction
-from .RegAlloc import get_liveness
-from itertools import chain, combinations
 from statistics import median
+from itertools import chain
 from math import floor
 
-def powerset(s):
-    return chain.from_iterable(combinations(s, r) for r in range(2, len(s)+1))
-
 
 def get_highest_reg_number(mp):
     """Returns the highest register number used"""
@@ -34,42 +30,175 @@ def get_edges(mp):
     return reg_shift_out, reg_add_out, reg_in
 
 
-def get_same_shift_candidates(mp, edges, n_reg):
-    """Gets all the candidate sets of shifts that are from the same source register in a common direction"""
+def get_live_counts(mp, edges, outputs=()):
+    """Returns the number of live registers at every instruction, as len(get_liveness(mp, outputs)) does. A register
+    is live from its definition up to its last use, the intervals are taken from the edges. Takes the time of the
+    length of the program, rather than of the sum of the live ranges"""
+    reg_shifts, reg_adds, reg_in = edges
+    diff = [0] * (len(mp) + 1)
+    for reg in set(reg_in) | set(reg_shifts) | set(reg_adds):
+        if reg in outputs:
+            continue
+        low = reg_in.get(reg, 0)
+        high = max(chain(reg_shifts.get(reg, ()), reg_adds.get(reg, ())), default=low)
+        if high > low:
+            diff[low] += 1
+            diff[high] -= 1
+    counts = []
+    live = 0
+    for i in range(len(mp)):
+        live += diff[i]
+        counts.append(live)
+    return counts
+
+
+class MetaProgramIR:
+    """A meta program together with its def/use edges (in the format of get_edges), the live register counts and the
+    highest register number. Rewrites of the relaxation passes go through insert and replace, which update the edges
+    in place instead of recomputing them from scratch. The live counts are derived from the edges when needed"""
+    def __init__(self, mp, outputs=()):
+        self.mp = mp
+        self.outputs = outputs
+        self.edges = get_edges(mp)
+        self.max_reg = get_highest_reg_number(mp)
+        self._live = None
+
+    def live_counts(self):
+        if self._live is None:
+            self._live = get_live_counts(self.mp, self.edges, self.outputs)
+        return self._live
+
+    def new_reg(self):
+        self.max_reg += 1
+        return self.max_reg
+
+    def _link(self, i, instr):
+        reg_shifts, reg_adds, reg_in = self.edges
+        reg_in[instr.target] = i
+        if isinstance(instr, MoveMetaIntstruction):
+            reg_shifts.setdefault(instr.source, set()).add(i)
+        else:
+            reg_adds.setdefault(instr.source, set()).add(i)
+            reg_adds.setdefault(instr.source2, set()).add(i)
+        self.max_reg = max(self.max_reg, instr.source, instr.target, getattr(instr, 'source2', 0))
+        self._live = None
+
+    def _unlink(self, i, instr):
+        reg_shifts, reg_adds, _ = self.edges
+        if isinstance(instr, MoveMetaIntstruction):
+            outs = [(reg_shifts, instr.source)]
+        else:
+            outs = [(reg_adds, instr.source), (reg_adds, instr.source2)]
+        for table, reg in outs:
+            if reg in table:
+                table[reg].discard(i)
+                if not table[reg]:
+                    del table[reg]
+        self._live = None
+
+    def insert(self, pos, instr):
+        """Inserts the instruction at pos, the instructions from pos on move one further"""
+        for table in self.edges[:2]:
+            for reg, addrs in table.items():
+                table[reg] = {i + 1 if i >= pos else i for i in addrs}
+        reg_in = self.edges[2]
+        for reg, i in reg_in.items():
+            if i >= pos:
+                reg_in[reg] = i + 1
+        self.mp.insert(pos, instr)
+        self._link(pos, instr)
+
+    def replace(self, i, instr):
+        """Replaces the instruction at i. The registers of a rewritten instruction have to be changed through this, its
+        shift and scale can be changed in place"""
+        self._unlink(i, self.mp[i])
+        self.mp[i] = instr
+        self._link(i, instr)
+
+
+def _common_shift(mp, s):
+    """Returns the shift (x, y) and scale all the moves s have in common, component by component in the same
+    direction"""
+    xp, xn, yp, yn, sp, sn = 1e6, 1e6, 1e6, 1e6, 1e6, 1e6
+    for i in s:
+        xp = max(min(xp, mp[i].shift[0]), 0)
+        xn = max(min(xn, -mp[i].shift[0]), 0)
+        yp = max(min(yp, mp[i].shift[1]), 0)
+        yn = max(min(yn, -mp[i].shift[1]), 0)
+        sp = max(min(sp, mp[i].scale), 0)
+        sn = max(min(sn, -mp[i].scale), 0)
+    return (xp-xn, yp-yn), sp-sn
+
+
+def _covers(value, common):
+    """True if a shift component value contains the common component. Every value contains a zero component"""
+    if common == 0:
+        return True
+    return value >= common if common > 0 else value <= common
+
+
+def _live_runs(addrs, live, n_reg):
+    """Splits the sorted addrs into runs, such that the live count between the first and the last address of a run is
+    lower than n_reg everywhere"""
+    runs, run = [], []
+    for addr in addrs:
+        if live[addr] >= n_reg:
+            if run:
+                runs.append(run)
+            run = []
+            continue
+        if run and any(live[i] >= n_reg for i in range(run[-1], addr)):
+            runs.append(run)
+            run = []
+        run.append(addr)
+    if run:
+        runs.append(run)
+    return runs
+
+
+def get_same_shift_candidates(mp, edges, n_reg, outputs=(), live=None):
+    """Gets the candidate sets of shifts that are from the same source register in a common direction. A set can only
+    be relaxed, if the liveness between its first and its last shift is lower than n_reg, so the shifts are split into
+    runs where this holds. For every possible common shift (x, y, scale), formed of the shift components present in a
+    run, the candidate is the set of all shifts of the run that contain it. The best set of any size is among these,
+    as a larger set with the same common shift is always better. live are the live counts of get_live_counts"""
     reg_shifts, _, _ = edges
-    liveness = get_liveness(mp)
+    if live is None:
+        live = get_live_counts(mp, edges, outputs)
 
     relax_candidates = []
-    # for every set of shifts take the power set and analyse every set if its beneficial to carry on
     for reg, addrs in reg_shifts.items():
         if len(addrs) < 2:  # there is nothing to optimize in a single shift
             continue
 
-        if len(addrs) > 20:
-            print('[WARNING] More than 20 shifts from same reg (%d). Powerset is not computable. Nothing done.'%len(addrs))
-            return []
-
-        for s in powerset(addrs):
-            # liveness has to be lower than n_reg for all
-            for i in range(min(s), max(s)+1):
-                if len(liveness[i]) >= n_reg:
-                    break
-            else:
-                xp, xn, yp, yn, sp, sn = 1e6, 1e6, 1e6, 1e6, 1e6, 1e6
-                for i in s:
-                    xp = max(min(xp, mp[i].shift[0]), 0)
-                    xn = max(min(xn, -mp[i].shift[0]), 0)
-                    yp = max(min(yp, mp[i].shift[1]), 0)
-                    yn = max(min(yn, -mp[i].shift[1]), 0)
-                    sp = max(min(sp, mp[i].scale), 0)
-                    sn = max(min(sn, -mp[i].scale), 0)
-                if xp>0 or xn>0 or yp>0 or yn>0 or sp>0 or sn>0:
-                    # format: (source, common shift, common scale, relaxed instructions)
-                    relax_candidates.append((reg, (xp-xn, yp-yn), sp-sn, s))
+        reg_candidates = []
+        for run in _live_runs(sorted(addrs), live, n_reg):
+            if len(run) < 2:
+                continue
+            xs = {0} | {mp[i].shift[0] for i in run}
+            ys = {0} | {mp[i].shift[1] for i in run}
+            scales = {0} | {mp[i].scale for i in run}
+            seen = set()
+            for cx in xs:
+                x_run = [i for i in run if _covers(mp[i].shift[0], cx)]
+                for cy in ys:
+                    xy_run = [i for i in x_run if _covers(mp[i].shift[1], cy)]
+                    for cs in scales:
+                        s = tuple(i for i in xy_run if _covers(mp[i].scale, cs))
+                        if len(s) < 2 or s in seen:
+                            continue
+                        seen.add(s)
+                        c_shift, c_scale = _common_shift(mp, s)
+                        if c_shift != (0, 0) or c_scale != 0:
+                            # format: (source, common shift, common scale, relaxed instructions)
+                            reg_candidates.append((reg, c_shift, c_scale, s))
+        # smaller sets first, like the power set, so ties between candidates are broken the same way
+        reg_candidates.sort(key=lambda x: (len(x[3]), x[3]))
+        relax_candidates.extend(reg_candidates)
     return relax_candidates
 
 
-def get_rebalance_in_pairs(mp, edges, liveness):
+def get_rebalance_in_pairs(mp, edges, live):
     reg_shifts, reg_adds, reg_in = edges
     pairs = [(r, r) for r in reg_in.keys()]
     # find all nodes with liveness 1 in or out
@@ -77,7 +206,7 @@ def get_rebalance_in_pairs(mp, edges, liveness):
     # find liveness 1 pairs
     for r in reg_in.keys():
         # expect liveness 1
-        if r in reg_in and len(liveness[reg_in[r]]) == 1:
+        if r in reg_in and live[reg_in[r]] == 1:
             if isinstance(mp[reg_in[r]], MoveMetaIntstruction):
                 l1in.append(r)
             else:
@@ -88,19 +217,23 @@ def get_rebalance_in_pairs(mp, edges, liveness):
     return pairs
 
 
-def get_rebalance_candidates(mp, edges, n_reg):
+def get_rebalance_candidates(mp, edges, n_reg, outputs=(), live=None):
     candidates = []
     reg_shifts, reg_adds, reg_in = edges
-    liveness = get_liveness(mp)
-    pairs = get_rebalance_in_pairs(mp, edges, liveness)
+    if live is None:
+        live = get_live_counts(mp, edges, outputs)
+    pairs = get_rebalance_in_pairs(mp, edges, live)
 
     for ri, ro in pairs:
+        # rebalancing changes the values of ri and ro, outputs have to keep theirs
+        if ri in outputs or ro in outputs:
+            continue
         # to optimize, we need at least one non-addition child and the parent has to be a move node
         if ro in reg_shifts and ri in reg_in and isinstance(mp[reg_in[ri]], MoveMetaIntstruction):
 
             # we need to be under live at the time of the adds, or the add has to be the last child, or there is no add
             if ro not in reg_adds or max(reg_shifts[ro]) < min(reg_adds[ro]) or \
-                    all([len(liveness[i]) < n_reg for i in range(min(reg_adds[ro])-1, max(reg_adds[ro]))]):
+                    all([live[i] < n_reg for i in range(min(reg_adds[ro])-1, max(reg_adds[ro]))]):
                 benefit = 0
 
                 shift_children = {mp[i] for i in reg_shifts[ro]}
@@ -134,8 +267,8 @@ def get_rebalance_candidates(mp, edges, n_reg):
 
 
 
-def eliminate_empty_shifts(mp):
-    """Removes empty shifts from the meta program"""
+def eliminate_empty_shifts(mp, outputs=()):
+    """Removes empty shifts from the meta program. Copies into outputs are kept"""
     c_map = {}
     affected_instrs = []
 
@@ -144,7 +277,8 @@ def eliminate_empty_shifts(mp):
             mp[i].source = c_map[mp[i].source]
         if isinstance(mp[i], AddMetaInstruction) and mp[i].source2 in c_map:
             mp[i].source2 = c_map[mp[i].source2]
-        if isinstance(mp[i], MoveMetaIntstruction) and mp[i].shift == (0,0) and mp[i].scale == 0 and not mp[i].neg:
+        if isinstance(mp[i], MoveMetaIntstruction) and mp[i].shift == (0,0) and mp[i].scale == 0 and not mp[i].neg \
+                and mp[i].target not in outputs:
             c_map[mp[i].target] = mp[i].source
             affected_instrs.append(mp[i])
 
@@ -153,36 +287,34 @@ def eliminate_empty_shifts(mp):
     return mp
 
 
-def relax_same_shift(meta_program, n_reg):
-    meta_program = eliminate_empty_shifts(meta_program)
+def relax_same_shift(meta_program, n_reg, outputs=()):
+    meta_program = eliminate_empty_shifts(meta_program, outputs)
+    ir = MetaProgramIR(meta_program, outputs)
     while True:
-        edges = get_edges(meta_program)
-        relax_candidates = get_same_shift_candidates(meta_program, edges, n_reg)
+        relax_candidates = get_same_shift_candidates(meta_program, ir.edges, n_reg, outputs, ir.live_counts())
         if len(relax_candidates) <= 0:
             break
         # select the best possible relax
         best_relax = max(relax_candidates, key=lambda x: len(x[3])*(abs(x[1][0]) + abs(x[1][1] + abs(x[2]))))
         source_reg, c_shift, c_scale, instrs = best_relax
-        # get current max reg number
-        temp_reg = get_highest_reg_number(meta_program) + 1
+        temp_reg = ir.new_reg()
 
         # add the common move instr at the first position of the instrs to be relaxed
         instrs = sorted(list(instrs))
-        meta_program.insert(instrs[0], MoveMetaIntstruction(source_reg, temp_reg, c_scale, c_shift))
+        ir.insert(instrs[0], MoveMetaIntstruction(source_reg, temp_reg, c_scale, c_shift))
         for i in instrs:
             oi = meta_program[i+1]
-            meta_program[i+1] = MoveMetaIntstruction(temp_reg, oi.target, oi.scale-c_scale, (oi.shift[0] - c_shift[0], oi.shift[1] - c_shift[1]), oi.neg)
-    meta_program = eliminate_empty_shifts(meta_program)
+            ir.replace(i+1, MoveMetaIntstruction(temp_reg, oi.target, oi.scale-c_scale, (oi.shift[0] - c_shift[0], oi.shift[1] - c_shift[1]), oi.neg))
+    meta_program = eliminate_empty_shifts(meta_program, outputs)
     return meta_program
 
 
 
-def relax_rebalance(mp, n_reg):
-    mp = eliminate_empty_shifts(mp)
+def relax_rebalance(mp, n_reg, outputs=()):
+    mp = eliminate_empty_shifts(mp, outputs)
+    ir = MetaProgramIR(mp, outputs)
     while True:
-        edges = get_edges(mp)
-
-        candidates = get_rebalance_candidates(mp, edges, n_reg)
+        candidates = get_rebalance_candidates(mp, ir.edges, n_reg, outputs, ir.live_counts())
         if len(candidates) <= 0:
             break
         # select best candidate first
@@ -197,13 +329,115 @@ def relax_rebalance(mp, n_reg):
             mp[m_i].scale = mp[m_i].scale - scale_diff
 
         if add_instrs:
-            temp_reg = get_highest_reg_number(mp) + 1
+            # the sets of the candidate are the ones of the edges, which change with the rewrites
+            add_instrs = sorted(add_instrs)
+            temp_reg = ir.new_reg()
             for add_instr in add_instrs:
-                if mp[add_instr].source == ro:
-                    mp[add_instr].source = temp_reg
-                if mp[add_instr].source2 == ro:
-                    mp[add_instr].source2 = temp_reg
-            mp.insert(min(add_instrs), MoveMetaIntstruction(ro, temp_reg, -scale_diff, (-shift_diff[0], -shift_diff[1])))
+                a = mp[add_instr]
+                ir.replace(add_instr, AddMetaInstruction(temp_reg if a.source == ro else a.source,
+                                                         temp_reg if a.source2 == ro else a.source2,
+                                                         a.s1neg, a.s2neg, a.target))
+            ir.insert(add_instrs[0], MoveMetaIntstruction(ro, temp_reg, -scale_diff, (-shift_diff[0], -shift_diff[1])))
+
+    mp = eliminate_empty_shifts(mp, outputs)
+    return mp
+
+
+def _replace_uses(mp, old, new):
+    """Makes all instructions read register new instead of old"""
+    for instr in mp:
+        if instr.source == old:
+            instr.source = new
+        if isinstance(instr, AddMetaInstruction) and instr.source2 == old:
+            instr.source2 = new
+
+
+def _last_use(edges, reg, default):
+    reg_shifts, reg_adds, _ = edges
+    return max(chain(reg_shifts.get(reg, ()), reg_adds.get(reg, ())), default=default)
+
+
+def _instr_key(instr):
+    """Instructions with the same key compute the same value"""
+    if isinstance(instr, MoveMetaIntstruction):
+        return 'm', instr.source, instr.scale, instr.shift, instr.neg
+    # additions are commutative
+    return ('a',) + tuple(sorted([(instr.source, instr.s1neg), (instr.source2, instr.s2neg)]))
 
-    mp = eliminate_empty_shifts(mp)
+
+def eliminate_common_subexpressions(mp, n_reg, outputs=()):
+    """Merges instructions that compute the same value (moves with the same source, shift and scale, additions of the
+    same operands), the uses of the later result read the earlier one instead. This keeps the earlier result live
+    until the uses of the later one, a merge is only done if the liveness stays lower than n_reg in between"""
+    protected = set(outputs) | {mp[-1].target}
+    merged = True
+    while merged:
+        merged = False
+        edges = get_edges(mp)
+        live = get_live_counts(mp, edges, outputs)
+        first = {}
+        for i, instr in enumerate(mp):
+            key = _instr_key(instr)
+            if key not in first:
+                first[key] = i
+                continue
+            if instr.target in protected:
+                continue
+            j = first[key]
+            # the earlier result is live up to its own last use already
+            if all(live[k] < n_reg for k in range(_last_use(edges, mp[j].target, j), i)):
+                _replace_uses(mp, instr.target, mp[j].target)
+                del mp[i]
+                merged = True
+                break
     return mp
+
+
+def eliminate_dead_instructions(mp, outputs=()):
+    """Removes instructions whose result is never used. The outputs and the last instruction are kept"""
+    used = set(outputs) | {mp[-1].target}
+    kept = []
+    for instr in reversed(mp):
+        if instr.target in used:
+            kept.append(instr)
+            used.add(instr.source)
+            if isinstance(instr, AddMetaInstruction):
+                used.add(instr.source2)
+    mp[:] = kept[::-1]
+    return mp
+
+
+def fold_move_chains(mp, outputs=()):
+    """Folds a move into the move that is the only use of its result. Shifts, scales and negations commute, so the
+    two are one move by the sum of both. The folded move is never longer, and the register pressure does not grow:
+    the source of the first move stays live instead of its result"""
+    protected = set(outputs) | {mp[-1].target}
+    folded = True
+    while folded:
+        folded = False
+        reg_shifts, reg_adds, _ = get_edges(mp)
+        for i, instr in enumerate(mp):
+            if not isinstance(instr, MoveMetaIntstruction) or instr.target in protected or instr.target in reg_adds \
+                    or len(reg_shifts.get(instr.target, ())) != 1:
+                continue
+            j = next(iter(reg_shifts[instr.target]))
+            second = mp[j]
+            mp[j] = MoveMetaIntstruction(instr.source, second.target, instr.scale + second.scale,
+                                         (instr.shift[0] + second.shift[0], instr.shift[1] + second.shift[1]),
+                                         instr.neg != second.neg)
+            del mp[i]
+            folded = True
+            break
+    return mp
+
+
+def optimize_meta_program(mp, n_reg, outputs=()):
+    """Peephole optimisation of a relaxed meta program, before the register allocation: folds move chains, merges
+    common subexpressions and removes dead instructions, until nothing changes anymore"""
+    while True:
+        length = len(mp)
+        mp = fold_move_chains(mp, outputs)
+        mp = eliminate_common_subexpressions(mp, n_reg, outputs)
+        mp = eliminate_dead_instructions(mp, outputs)
+        if len(mp) == length:
+            return mp
@@ -2,8 +2,9 @@ from .MetaProgrammer import AddMetaInstruction, MoveMetaIntstruction
 import scamp_filter.Grapher as Grapher
 
 
-def get_liveness(meta_program):
-    """Algorithm gets the live set of registers at every instruction"""
+def get_liveness(meta_program, outputs=()):
+    """Algorithm gets the live set of registers at every instruction. Outputs are held in target registers of their
+    own, and are left out"""
     min_table = {0: 0}
     max_table = {}
 
@@ -21,6 +22,8 @@ def get_liveness(meta_program):
 
     l = [set() for _ in range(len(meta_program))]
     for reg in min_table.keys():
+        if reg in outputs:
+            continue
         low, high = min_table[reg], max_table[reg]
         for i in range(low, high):
             l[i].add(reg)
@@ -83,10 +86,12 @@ def allocate_coloring(meta_program, coloring):
     return meta_program
 
 
-def alloc(meta_program, n_reg, verbose=0):
+def alloc(meta_program, n_reg, verbose=0, outputs=()):
+    """Allocates n_reg registers to the meta program. The outputs are not allocated, as they are held in target
+    registers of their own. They get the register numbers n_reg, n_reg+1, ... in the order given"""
     if verbose > 0:
         print('| >> Register liveness analysis')
-    liveness = get_liveness(meta_program)
+    liveness = get_liveness(meta_program, outputs)
     min_reg = len(max(liveness, key=len))
     if verbose > 0:
         print('| ... Done. At most, %d registers are live at the same time' % min_reg)
@@ -102,7 +107,8 @@ def alloc(meta_program, n_reg, verbose=0):
     if verbose > 0:
         print('| ..Done')
     if coloring is None:
-        print('[Error] There is no register allocation with %d registers possible' % n_reg)
+        raise ValueError('[Error] There is no register allocation with %d registers possible' % n_reg)
+    coloring.update({reg: n_reg + i for i, reg in enumerate(outputs)})
 
     if verbose > 9:
         Grapher.print_reg_graph(graph, coloring, verbose>10, title='Register allocation graph colouring')
@@ -92,7 +92,14 @@ def generate_scamp_add(source1, source2, s1neg, s2neg, target, reg_names, out_fo
         return [patterns['addneg'].format(t, s1, s2)], 1
 
 
-def generate_scamp_program(meta_program, available_regs, start_reg, target_reg, out_format):
+def generate_scamp_program(meta_program, available_regs, start_reg, target_reg, out_format, outputs=None):
+    """Generates the SCAMP code of an allocated meta program. The result of the last instruction is written to
+    target_reg. If a list of target regs is given as outputs instead, output i of the meta program is expected in
+    register len(available_regs)+i (as numbered by RegAlloc.alloc), and written to outputs[i]"""
+
+    # the outputs follow the available regs
+    if outputs is not None:
+        available_regs.extend(outputs)
 
     # if we can overwrite the start reg, have to order the names in a way that it works
     if start_reg in available_regs:
@@ -104,9 +111,10 @@ def generate_scamp_program(meta_program, available_regs, start_reg, target_reg,
         exp_pos = meta_program[0].source
         meta_program.insert(0, MoveMetaIntstruction(len(available_regs)-1, exp_pos, 0, (0, 0), False))
 
-    # append target_reg, to be used by last instr
-    available_regs.append(target_reg)
-    meta_program[-1].target = len(available_regs) -1
+    if outputs is None:
+        # append target_reg, to be used by last instr
+        available_regs.append(target_reg)
+        meta_program[-1].target = len(available_regs) -1
 
     program = []
     program.append('// ----------------------------------------------------')
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import numpy as np
+
+# bump this, whenever the format of the cached entries or the generated programs changes. Entries of older versions
+# are never looked up again, and are evicted eventually
+CACHE_VERSION = 14
+
+
+class KernelCache:
+    """Content addressed on-disk cache for generated SCAMP programs. Every entry is a single file named after the hash
+    of everything the program depends on. Entries are written to a temporary file first and then moved into place,
+    so several processes can share a cache directory without ever reading a partially written entry. Once the cache
+    grows beyond max_bytes, the least recently used entries are evicted. The size of the cache is estimated from the
+    entries written since the directory was last scanned, so it is only scanned when the estimate exceeds max_bytes.
+    Entries written by other processes are only seen by the next scan, the cache may grow beyond max_bytes until then"""
+    def __init__(self, directory, max_bytes=64 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.size = self._scan_size()
+
+    def _scan_size(self):
+        size = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                try:
+                    size += os.stat(os.path.join(self.directory, name)).st_size
+                except FileNotFoundError:  # evicted by another process
+                    pass
+        return size
+
+    def key(self, filter, **params):
+        """Returns the key of a filter compiled with the given parameters. Parameters are hashed through their repr,
+        objects (like PairGenProps) through their attributes"""
+        h = hashlib.sha256()
+        h.update(repr(CACHE_VERSION).encode())
+        filter = np.ascontiguousarray(filter, dtype=np.float64)
+        h.update(repr(filter.shape).encode())
+        h.update(filter.tobytes())
+        for name, value in sorted(params.items()):
+            if hasattr(value, '__dict__'):
+                value = sorted(vars(value).items())
+            h.update(('%s=%r;' % (name, value)).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key):
+        """Returns the cached entry, or None if there is none. An entry that can not be loaded, e.g. because it was
+        written by an older version with other class layouts, is a miss as well"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                entry = pickle.load(file)
+        except Exception:
+            return None
+        # mark the entry as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        """Stores an entry atomically, and evicts old entries if the cache got too large"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                pickle.dump(entry, file)
+                file.flush()
+                os.fsync(file.fileno())
+                # an entry that replaces another one is counted twice, until the next scan
+                self.size += file.tell()
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if self.size > self.max_bytes:
+            # make room for more entries at once, so the directory is not scanned again on the next write
+            self.evict(self.max_bytes * 3 // 4)
+
+    def evict(self, max_bytes=None):
+        """Removes the least recently used entries until the cache fits into max_bytes (by default the max_bytes of
+        the cache)"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pkl'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:  # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, name in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
@@ -5,7 +5,14 @@ from itertools import groupby
 from .costs import operation_cost
 from itertools import chain
 from math import log2
+import heapq
+from collections import Counter, OrderedDict
+import threading
+from itertools import count
+import numpy as np
 L_INT = 1e6
+# number of atoms the pairs in the pair cache may hold in total
+PAIR_CACHE_VOLUME = 2000000
 
 
 class ElemMove:
@@ -23,6 +30,171 @@ class ElemMove:
         return ('Take %d generate %d'%(self.n_sources, self.n_targets)) + ' from ' + str(self.sources) + ' to ' + str(self.targets)
 
 
+class CountGoal(Counter):
+    """A goal given by the number of atoms at every position (x, y, neg), instead of a set of atoms. Its size and the
+    cost of working with it only depend on the number of distinct positions, not on the number of atoms. Note that len
+    gives the number of positions, n_atoms the number of atoms"""
+    @classmethod
+    def from_atoms(cls, goal):
+        return cls(a.val() for a in goal)
+
+    def n_atoms(self):
+        return sum(self.values())
+
+    def subtract_counts(self, counts):
+        """Returns a new count goal with the counts removed"""
+        goal = CountGoal(self)
+        for pos, n in counts.items():
+            if goal[pos] > n:
+                goal[pos] -= n
+            else:
+                del goal[pos]
+        return goal
+
+
+_table_ids = count()
+
+
+class AtomTable:
+    """Assigns a bit to every atom of the goals a search starts from. The search never creates atoms, every goal it
+    reaches is a subset of these atoms and can be encoded as an integer mask. The atoms are numbered by their ids, so
+    the lowest bits of a mask are the atoms with the lowest ids. The tables are numbered, so masks of different tables
+    can be told apart"""
+    def __init__(self, goals):
+        self.id = next(_table_ids)
+        self.atoms = sorted(set().union(*goals), key=lambda a: a.nr)
+        self.bits = {a.nr: 1 << i for i, a in enumerate(self.atoms)}
+        # mask of all atoms at a position (x, y, neg)
+        self.pos_masks = {}
+        for a in self.atoms:
+            self.pos_masks[a.val()] = self.pos_masks.get(a.val(), 0) | self.bits[a.nr]
+
+    def encode(self, atoms):
+        mask = 0
+        for a in atoms:
+            mask |= self.bits[a.nr]
+        return mask
+
+    def decode(self, mask):
+        atoms = []
+        while mask:
+            low = mask & -mask
+            atoms.append(self.atoms[low.bit_length() - 1])
+            mask ^= low
+        return atoms
+
+
+class BitGoal:
+    """A goal encoded as an integer mask over an AtomTable. Set algebra on bit goals is integer arithmetic, and pairs
+    are formed on the masks of the positions, so the atoms are only decoded when a plan is translated back"""
+    __slots__ = ('mask', 'table', '_atoms')
+
+    def __init__(self, mask, table):
+        self.mask = mask
+        self.table = table
+        self._atoms = None
+
+    @classmethod
+    def from_atoms(cls, goal, table):
+        return cls(table.encode(goal), table)
+
+    def atoms(self):
+        if self._atoms is None:
+            self._atoms = self.table.decode(self.mask)
+        return self._atoms
+
+    def position_counts(self):
+        """Returns the number of atoms at every position (x, y, neg) of the goal"""
+        return {pos: (self.mask & pos_mask).bit_count() for pos, pos_mask in self.table.pos_masks.items()
+                if self.mask & pos_mask}
+
+    def position_masks(self):
+        """Returns the masks of the atoms of the goal at every position (x, y, neg) of the goal"""
+        return {pos: self.mask & pos_mask for pos, pos_mask in self.table.pos_masks.items() if self.mask & pos_mask}
+
+    def issubset(self, other):
+        return not self.mask & ~other.mask
+
+    def difference(self, other):
+        return BitGoal(self.mask & ~other.mask, self.table)
+
+    def __or__(self, other):
+        return BitGoal(self.mask | other.mask, self.table)
+
+    def __iter__(self):
+        return iter(self.atoms())
+
+    def __len__(self):
+        return self.mask.bit_count()
+
+    def __contains__(self, atom):
+        return bool(self.mask & self.table.bits.get(atom.nr, 0))
+
+    def __eq__(self, other):
+        return isinstance(other, BitGoal) and self.mask == other.mask and self.table.id == other.table.id
+
+    def __hash__(self):
+        return hash(self.mask)
+
+    def __str__(self):
+        return str(set(self.atoms()))
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class PairCache:
+    """Thread safe LRU cache for the pairs formed of two goals. Counts its hits and misses. The size of the cache is
+    bounded by its volume, the number of atoms held by the pairs of all entries, as the number of pairs of a goal pair
+    and their size grow quickly with the size of the goals"""
+    def __init__(self, max_volume):
+        self.max_volume = max_volume
+        self.volume = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, pairs):
+        volume = 1 + sum(len(up) + len(down) for _, (up, down) in pairs)
+        with self.lock:
+            if key in self.entries:
+                self.volume -= self.entries.pop(key)[1]
+            self.entries[key] = (pairs, volume)
+            self.volume += volume
+            while self.volume > self.max_volume and self.entries:
+                self.volume -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.volume = 0
+
+
+_pair_cache = PairCache(PAIR_CACHE_VOLUME)
+
+
+def pair_cache_stats():
+    """Returns the number of hits and misses of the pair cache so far"""
+    return _pair_cache.hits, _pair_cache.misses
+
+
+def clear_pair_cache():
+    """Drops the pairs in the pair cache. The goals of different filters rarely coincide, so the pairs are hardly of
+    use after the search they were formed in"""
+    _pair_cache.clear()
+
+
 def translate_goal(igoal, scale, nr_offset=0):
     """Translates an item goal (pre-goal) into an atom goal. An item is represented as (scale, x, y) and always
     unique in a set. An atom is ([nr], x, y) and globally unique. An atom has a fixed 2^-D scale."""
@@ -60,6 +232,10 @@ def translate_back_set(s, scale):
     locations, and generates Items with appropriate scales by using the get_scales function"""
     if not s:
         return set()
+    if isinstance(s, BitGoal):
+        s = CountGoal(s.position_counts())
+    if isinstance(s, CountGoal):
+        return {I(item_scale, x, y, neg) for (x, y, neg), n in s.items() for item_scale in get_scales(n, scale)}
     s = list(s)
     s.sort(key=lambda i: (i.x, i.y))
     o_x, o_y, o_p = s[0].x, s[0].y, s[0].neg
@@ -88,6 +264,38 @@ def distinct_pos(s):
     return pos
 
 
+def distinct_pos_scorer(agoals):
+    """Returns a function that scores a pair (up, down) by distinct_pos(set.union(*agoals).difference(up) | down),
+    the number of distinct positions left after the pair is applied. The atoms at every position are counted once, a
+    pair is then scored by the positions it removes all atoms of, in the time of the size of the pair"""
+    if isinstance(agoals[0], BitGoal):
+        return _bit_distinct_pos_scorer(agoals)
+    counts = Counter(a.val() for a in set.union(*agoals))
+
+    def score(pair):
+        up, down = pair
+        removed = Counter(a.val() for a in up if a not in down)
+        return len(counts) - sum(1 for pos, n in removed.items() if n == counts[pos])
+    return score
+
+
+def _bit_distinct_pos_scorer(agoals):
+    """Bit goal version of distinct_pos_scorer. A position is removed by a pair, if the pair removes all the atoms of
+    the goals at the position"""
+    table = agoals[0].table
+    union = 0
+    for goal in agoals:
+        union |= goal.mask
+    # the atoms of the goals at every position
+    pos_atoms = [union & pos_mask for pos_mask in table.pos_masks.values() if union & pos_mask]
+
+    def score(pair):
+        up, down = pair
+        removed = up.mask & ~down.mask
+        return len(pos_atoms) - sum(1 for atoms in pos_atoms if not atoms & ~removed)
+    return score
+
+
 def get_distances(s1, s2):
     """Returns the distances from every atom to every other in the given set"""
     distances = []
@@ -119,16 +327,124 @@ def generate_elementary_moves(group):
     emoves = []
     for key, cluster in clusters.items():
         sources, targets = {a.nr for a, _ in cluster}, {b.nr for _, b in cluster}
-        for n_sources in range(int(log2(len(sources)))+1):
-            for n_targets in range(int(log2(len(targets)))+1):
-                if n_sources != n_targets or sources != targets:
-                    emoves.append(ElemMove(sources, targets, 2**n_sources, 2**n_targets, key))
+        emoves.extend(_cluster_emoves(sources, targets, key))
+    return emoves
+
+
+def _cluster_emoves(sources, targets, key):
+    """Creates the elementary moves of a cluster, one for each allowed ratio (n_sources/n_targets)"""
+    emoves = []
+    for n_sources in range(int(log2(len(sources)))+1):
+        for n_targets in range(int(log2(len(targets)))+1):
+            if n_sources != n_targets or sources != targets:
+                emoves.append(ElemMove(sources, targets, 2**n_sources, 2**n_targets, key))
+    return emoves
+
+
+def _low_bits(mask, n):
+    """Returns the n lowest bits set in the mask"""
+    bits = 0
+    for _ in range(n):
+        low = mask & -mask
+        bits |= low
+        mask ^= low
+    return bits
+
+
+def _bit_cluster_emoves(sources, targets, key):
+    """Bit goal version of _cluster_emoves. sources and targets are masks of the atoms"""
+    emoves = []
+    for n_sources in range(int(log2(sources.bit_count()))+1):
+        for n_targets in range(int(log2(targets.bit_count()))+1):
+            if n_sources != n_targets or sources != targets:
+                emoves.append(ElemMove(sources, targets, 2**n_sources, 2**n_targets, key))
     return emoves
 
 
-def group_emoves(emoves, props):
+def bit_distance_groups(goal1, goal2):
+    """Bit goal version of get_distance_groups. The distances are computed between the distinct positions of the
+    goals, the elementary moves take the atoms at the positions as masks"""
+    masks1, masks2 = goal1.position_masks(), goal2.position_masks()
+    groups = {}
+    for p, m1 in masks1.items():
+        for q, m2 in masks2.items():
+            dist = (p[0] - q[0], p[1] - q[1], p[2] != q[2])
+            if dist not in groups:
+                groups[dist] = []
+            groups[dist].extend(_bit_cluster_emoves(m1, m2, (p, q)))
+    return {dist: groups[dist] for dist in sorted(groups)}
+
+
+def _take_bit_emove(emove, used):
+    """Bit goal version of _take_emove. The atoms with the lowest ids that are not used yet are taken, used and the
+    atoms taken are masks"""
+    source_candidates, target_candidates = emove.sources & ~used, emove.targets & ~used
+    if source_candidates.bit_count() < emove.n_sources or target_candidates.bit_count() < emove.n_targets:
+        return None
+    sources, targets = _low_bits(source_candidates, emove.n_sources), _low_bits(target_candidates, emove.n_targets)
+    complete = sources == source_candidates and targets == target_candidates
+    return used | sources | targets, (emove, sources, targets), complete
+
+
+def _bit_pair(emove_alloc, table):
+    """Bit goal version of _atom_pair"""
+    up, down = 0, 0
+    for (_, sources, targets) in emove_alloc:
+        up |= sources
+        down |= targets
+    return BitGoal(up, table), BitGoal(down, table)
+
+
+def _group_positions(goal):
+    """Groups the atoms of a goal by position. Returns the positions (x, y, neg), in the order they first appear in
+    the goal, and the lists of the atom ids at every position"""
+    ids = {}
+    for a in goal:
+        if a.val() in ids:
+            ids[a.val()].append(a.nr)
+        else:
+            ids[a.val()] = [a.nr]
+    return list(ids.keys()), list(ids.values())
+
+
+def get_distance_groups(goal1, goal2):
+    """Array based version of get_distances and the grouping in form_pairs. As all atoms at the same position have
+    the same distances, only the distances between the distinct positions of the goals are computed, all at once
+    with numpy. Returns a dict with the distance as key, and the elementary moves of the distance as value. The
+    distances, the moves and their order are the same as the ones of the list based version"""
+    pos1, ids1 = _group_positions(goal1)
+    pos2, ids2 = _group_positions(goal2)
+    p1, p2 = np.array(pos1, dtype=np.int64), np.array(pos2, dtype=np.int64)
+    dx = (p1[:, 0, None] - p2[None, :, 0]).ravel()
+    dy = (p1[:, 1, None] - p2[None, :, 1]).ravel()
+    dneg = (p1[:, 2, None] != p2[None, :, 2]).ravel()
+
+    # stable sort by distance, position pairs with the same distance keep the order of the goals
+    order = np.lexsort((dneg, dy, dx))
+    dx, dy, dneg = dx[order], dy[order], dneg[order]
+    starts = np.flatnonzero(np.concatenate(([True], (dx[1:] != dx[:-1]) | (dy[1:] != dy[:-1]) |
+                                            (dneg[1:] != dneg[:-1]))))
+    ends = np.append(starts[1:], len(order))
+    i1, i2 = np.divmod(order, len(pos2))
+
+    groups = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        emoves = []
+        for i, j in zip(i1[start:end].tolist(), i2[start:end].tolist()):
+            emoves.extend(_cluster_emoves(set(ids1[i]), set(ids2[j]), (pos1[i], pos2[j])))
+        groups[(int(dx[start]), int(dy[start]), bool(dneg[start]))] = emoves
+    return groups
+
+
+def group_emoves(emoves, props, take=None, used=frozenset(), make_pair=None):
     """Elementary moves with the same scale ratio can be combined. All emoves are from the same group, so they
-    share the same transformation distance. We can combine all emoves that also share the same scale ratio."""
+    share the same transformation distance. We can combine all emoves that also share the same scale ratio.
+    take(emove, used) takes the atoms of an emove that are not used yet, and returns the atoms used afterwards, the
+    allocation of the emove and whether all atoms left were taken (or None, if not enough atoms are left). used are the
+    atoms used at the start, and make_pair forms the pair (up, down) of a list of allocations. They default to goals
+    that are sets of atoms, the bit and count goal versions are _take_bit_emove and _take_count_emove"""
+    take = _take_emove if take is None else take
+    make_pair = _atom_pair if make_pair is None else make_pair
     # group the emoves by ratio
     emoves.sort(key=lambda x: x.n_sources/x.n_targets)
     emovemap = {ratio: list(emove) for ratio, emove in groupby(emoves, key=lambda x: x.n_sources/x.n_targets)}
@@ -143,8 +459,8 @@ def group_emoves(emoves, props):
         ratio_emoves = emovemap[ratio]
 
         # we generate the a list of possible allocations to the emoves, that work to form a possible pair
-        line_gen = _group_emoves_lines(ratio_emoves, ratio)
-        exhaust_gen = _group_emoves_exhaust(ratio_emoves, 0, set(), props)
+        line_gen = _group_emoves_lines(ratio_emoves, used, take)
+        exhaust_gen = _group_emoves_exhaust(ratio_emoves, 0, used, take, props)
 
         if props.exhaustive and props.line:
             gen = chain(line_gen, exhaust_gen)
@@ -155,44 +471,57 @@ def group_emoves(emoves, props):
 
         # generate the actual pair out of the emove allocation
         for emove_alloc in gen:
-            if emove_alloc is None:
+            if not emove_alloc:
                 continue
-            up, down = set(), set()
-            for (emove, sources, targets) in emove_alloc:
-                (lx, ly, lneg), (hx, hy, hneg) = emove.move
-                up |= {A(nr, lx, ly, lneg) for nr in sources}
-                down |= {A(nr, hx, hy, hneg) for nr in targets}
-            yield (up, down)
+            yield make_pair(emove_alloc)
+
+
+def _take_emove(emove, used):
+    """Takes the atoms of an emove that are not used yet. used and the atoms taken are sets of atom ids"""
+    source_candidates = list(emove.sources.difference(used))
+    target_candidates = list(emove.targets.difference(used))
+    if len(source_candidates) < emove.n_sources or len(target_candidates) < emove.n_targets:
+        return None
+    sources = {source_candidates[i] for i in range(emove.n_sources)}
+    targets = {target_candidates[i] for i in range(emove.n_targets)}
+    complete = len(sources) == len(source_candidates) and len(targets) == len(target_candidates)
+    return used | sources | targets, (emove, sources, targets), complete
+
 
+def _atom_pair(emove_alloc):
+    """Forms the pair (up, down) of atom sets of an emove allocation"""
+    up, down = set(), set()
+    for (emove, sources, targets) in emove_alloc:
+        (lx, ly, lneg), (hx, hy, hneg) = emove.move
+        up |= {A(nr, lx, ly, lneg) for nr in sources}
+        down |= {A(nr, hx, hy, hneg) for nr in targets}
+    return up, down
 
-def _group_emoves_exhaust(emoves, pos, used_nrs, props):
+
+def _group_emoves_exhaust(emoves, pos, used, take, props):
     """Exhaustively groups emoves to all possible sets"""
     if pos >= len(emoves):
         return []
 
     emove = emoves[pos]
-    # allocate
-    source_candidates = list(emove.sources.difference(used_nrs))
-    target_candidates = list(emove.targets.difference(used_nrs))
-
     # assume not taking it
-    yield from _group_emoves_exhaust(emoves, pos+1, used_nrs, props)
+    yield from _group_emoves_exhaust(emoves, pos+1, used, take, props)
     # take it, if possible
-    if len(source_candidates) >= emove.n_sources and len(target_candidates) >= emove.n_targets:
-        sources = {source_candidates[i] for i in range(emove.n_sources)}
-        targets = {target_candidates[i] for i in range(emove.n_targets)}
-        take_plans = _group_emoves_exhaust(emoves, pos+1, used_nrs | sources | targets, props)
+    taken = take(emove, used)
+    if taken is not None:
+        new_used, alloc, complete = taken
+        take_plans = _group_emoves_exhaust(emoves, pos+1, new_used, take, props)
         for plan in take_plans:
-            yield [(emove, sources, targets)] + plan
-        if len(sources) == len(source_candidates) and len(targets) == len(target_candidates) or not props.max_sets:
-            yield [(emove, sources, targets)]
+            yield [alloc] + plan
+        if complete or not props.max_sets:
+            yield [alloc]
 
 
-def _group_emoves_lines(emoves, ratio):
+def _group_emoves_lines(emoves, used, take):
     """Tries to group emoves in a way that they form compact clusters"""
     # detect movement
     s_pos, t_pos = emoves[0].move
-    x_mov, y_mov = s_pos[0] - t_pos[0], s_pos[1] - t_pos[1]
+    x_mov = s_pos[0] - t_pos[0]
     # if we only have x movement, prefer to have emoves in same row
     if x_mov == 0:
         emoves.sort(key=lambda x: (x.move[0][1], x.move[0][0], -x.n_sources))
@@ -201,68 +530,273 @@ def _group_emoves_lines(emoves, ratio):
     else:
         emoves.sort(key=lambda x: (x.move[0][0], x.move[0][1], -x.n_sources))
 
-    used = set()
     plan = []
     # go through the emoves, and add them all
-    for i, emove in enumerate(emoves):
-        source_candidates = list(emove.sources.difference(used))
-        target_candidates = list(emove.targets.difference(used))
-
-        if len(source_candidates) >= emove.n_sources and len(target_candidates) >= emove.n_targets:
-            sources = {source_candidates[i] for i in range(emove.n_sources)}
-            targets = {target_candidates[i] for i in range(emove.n_targets)}
-            used = used | sources | targets
-            plan.append((emove, sources, targets))
+    for emove in emoves:
+        taken = take(emove, used)
+        if taken is not None:
+            used, alloc, _ = taken
+            plan.append(alloc)
     yield plan
 
 
-def form_pairs(goal1, goal2, props):
-    """Looks for sets of atoms with the same distances"""
-
-    distances = get_distances(goal1, goal2)
+def distance_groups(goal1, goal2, props):
+    """Groups the atoms of the goals by their distance. Returns a list of the distances (x, y, neg) and their groups,
+    in the order the pairs are formed in. A group is a list of atom pairs (a, b), or a list of elementary moves if
+    vectorized or if the goals are bit goals"""
+    if isinstance(goal1, BitGoal):
+        groups = bit_distance_groups(goal1, goal2)
+    elif props.vectorized:
+        groups = get_distance_groups(goal1, goal2)
+    else:
+        distances = get_distances(goal1, goal2)
 
-    distances.sort(key=itemgetter(0))
-    groups = {}
-    # group the ones with the same distance
-    for dist, s in groupby(distances, key=itemgetter(0)):
-        groups[dist] = [t for _, t in s]
+        distances.sort(key=itemgetter(0))
+        groups = {}
+        # group the ones with the same distance
+        for dist, s in groupby(distances, key=itemgetter(0)):
+            groups[dist] = [t for _, t in s]
 
     dists = list(groups.keys())
     if props.short_distance_first:
         dists.sort(key=lambda x: sum(abs(i) for i in x))
+    return [(dist, groups[dist]) for dist in dists]
 
-    for dist in dists:
-        group = groups[dist]
 
-        base_cost = operation_cost['add'] + (abs(dist[0]) + abs(dist[1])) * operation_cost['shift'] + \
-                    (operation_cost['neg'] if dist[0] == 0 and dist[1] == 0 and dist[2] else 0)
+def distance_cost(dist):
+    """Returns the cost of a pair at the distance, without the scale cost"""
+    return operation_cost['add'] + (abs(dist[0]) + abs(dist[1])) * operation_cost['shift'] + \
+        (operation_cost['neg'] if dist[0] == 0 and dist[1] == 0 and dist[2] else 0)
+
 
-        emoves = generate_elementary_moves(group)
+def form_group_pairs(dist, group, goal1, props):
+    """Forms the pairs (cost, (up, down)) of a distance group. The scale ratios of the pairs are taken in increasing
+    order, and pairs of a ratio r > 1 always pay log2(r) doubles, so the pairs of a group come in increasing cost"""
+    base_cost = distance_cost(dist)
+
+    if isinstance(goal1, BitGoal):
+        pairs = group_emoves(group, props, _take_bit_emove, 0, lambda emove_alloc: _bit_pair(emove_alloc, goal1.table))
+    else:
+        emoves = group if props.vectorized else generate_elementary_moves(group)
         pairs = group_emoves(emoves, props)
 
-        for pair in pairs:
-            if len(pair[0]) > len(pair[1]):
-                scale_cost = (log2(len(pair[0])/len(pair[1]))) * operation_cost['double']
-            else:
-                scale_cost = (log2(len(pair[1]) / len(pair[0]))) * operation_cost['div']
-            yield (base_cost + scale_cost, pair)
+    for pair in pairs:
+        if len(pair[0]) > len(pair[1]):
+            scale_cost = (log2(len(pair[0])/len(pair[1]))) * operation_cost['double']
+        else:
+            scale_cost = (log2(len(pair[1]) / len(pair[0]))) * operation_cost['div']
+        yield (base_cost + scale_cost, pair)
+
+
+def form_pairs(goal1, goal2, props):
+    """Looks for sets of atoms with the same distances"""
+    for dist, group in distance_groups(goal1, goal2, props):
+        yield from form_group_pairs(dist, group, goal1, props)
+
+
+def form_pairs_cached(goal1, goal2, props):
+    """Returns the list of pairs of form_pairs. A child state leaves most goals of its parent unchanged, so the pairs
+    of a goal pair are kept in an LRU cache, and taken from there when the same goal pair shows up again"""
+    if isinstance(goal1, BitGoal):
+        goal_key = (goal1.table.id, goal1.mask, goal2.mask)
+    else:
+        goal_key = (frozenset((a.nr, a.x, a.y, a.neg) for a in goal1), frozenset((a.nr, a.x, a.y, a.neg) for a in goal2))
+    key = goal_key + (props.short_distance_first, props.low_scale_first, props.exhaustive, props.line, props.max_sets)
+    pairs = _pair_cache.get(key)
+    if pairs is None:
+        pairs = list(form_pairs(goal1, goal2, props))
+        _pair_cache.put(key, pairs)
+    return pairs
 
 
 def generate_pairs(agoals, props):
     """Forms all the pairs that are applicable to the current goals"""
+    form = form_pairs_cached if props.memoize_pairs else form_pairs
     all_pairs = []
     for i in range(0, len(agoals)):
         for j in range(i, len(agoals)):
             goal1, goal2 = agoals[i], agoals[j]
-            all_pairs.extend(list(form_pairs(goal1, goal2, props)))
+            all_pairs.extend(list(form(goal1, goal2, props)))
     if props.sort_distinct_pos:
-        all_pairs.sort(key=lambda p: distinct_pos(set.union(*agoals).difference(p[1][0]) | p[1][1]))
+        score = distinct_pos_scorer(agoals)
+        all_pairs.sort(key=lambda p: score(p[1]))
     return all_pairs
 
 
 def generate_pairs_gen(agoals, props):
-    """Forms all the pairs that are applicable to the current goals"""
+    """Forms all the pairs that are applicable to the current goals. With the pair cache, the pairs of a goal pair are
+    formed all at once"""
+    form = form_pairs_cached if props.memoize_pairs else form_pairs
+    for i in range(0, len(agoals)):
+        for j in range(i, len(agoals)):
+            goal1, goal2 = agoals[i], agoals[j]
+            yield from form(goal1, goal2, props)
+
+
+def _group_source_positions(group):
+    """Returns the positions the up atoms of the pairs of a distance group are taken from"""
+    if group and isinstance(group[0], ElemMove):
+        return {emove.move[0] for emove in group}
+    return {a.val() for a, _ in group}
+
+
+def generate_pairs_merged(agoals, props):
+    """Forms all the pairs that are applicable to the current goals lazily, in global order of their cost (or of their
+    distinct position score with sort_distinct_pos). The distance groups of all goal pairs are merged with a heap.
+    A group is only formed once its lower bound (the cost of its distance, or the score if all the positions its up
+    atoms are taken from were removed) comes up, and the heap then holds the next pair of its stream. The pairs of a
+    group come in cost order, with sort_distinct_pos they are sorted when the group is formed. The pair cache is not
+    used, as it holds the pairs of goal pairs that have been formed completely"""
+    if props.sort_distinct_pos:
+        score = distinct_pos_scorer(agoals)
+        key = lambda p: score(p[1])
+        positions = set()
+        for goal in agoals:
+            positions.update(goal.position_counts() if isinstance(goal, BitGoal) else (a.val() for a in goal))
+        bound = lambda dist, group: len(positions) - len(_group_source_positions(group))
+    else:
+        key = itemgetter(0)
+        bound = lambda dist, group: distance_cost(dist)
+
+    # entries are (key, is_bound, tie, item), at equal keys pairs are taken before groups are formed
+    tie = count()
+    heap = []
     for i in range(0, len(agoals)):
         for j in range(i, len(agoals)):
             goal1, goal2 = agoals[i], agoals[j]
-            yield from form_pairs(goal1, goal2, props)
\ No newline at end of file
+            for dist, group in distance_groups(goal1, goal2, props):
+                heap.append((bound(dist, group), True, next(tie), (dist, group, goal1)))
+    heapq.heapify(heap)
+
+    def push_next(stream):
+        pair = next(stream, None)
+        if pair is not None:
+            heapq.heappush(heap, (key(pair), False, next(tie), (pair, stream)))
+
+    while heap:
+        _, is_bound, _, item = heapq.heappop(heap)
+        if is_bound:
+            dist, group, goal1 = item
+            stream = form_group_pairs(dist, group, goal1, props)
+            if props.sort_distinct_pos:
+                stream = iter(sorted(stream, key=key))
+            push_next(stream)
+        else:
+            pair, stream = item
+            yield pair
+            push_next(stream)
+
+
+def _count_cluster_emoves(n_sources, n_targets, same, move):
+    """Count goal version of _cluster_emoves. sources and targets are the numbers of atoms at the positions, same
+    tells if they are the same atoms"""
+    emoves = []
+    for n_s in range(int(log2(n_sources))+1):
+        for n_t in range(int(log2(n_targets))+1):
+            if n_s != n_t or not same:
+                emoves.append(ElemMove(n_sources, n_targets, 2**n_s, 2**n_t, move))
+    return emoves
+
+
+def _take_count_emove(emove, used, same_goal):
+    """Count goal version of _take_emove. The atoms used so far are counted per (goal, position), the allocation is
+    the emove itself. Within a cluster of a goal with itself, the sources and the targets are the same atoms"""
+    (source_pos, target_pos) = emove.move
+    source_key, target_key = (0, source_pos), (0 if same_goal else 1, target_pos)
+    if emove.sources - used[source_key] < emove.n_sources or emove.targets - used[target_key] < emove.n_targets:
+        return None
+    used = used.copy()
+    if source_key == target_key:
+        used[source_key] += max(emove.n_sources, emove.n_targets)
+    else:
+        used[source_key] += emove.n_sources
+        used[target_key] += emove.n_targets
+    complete = used[source_key] == emove.sources and used[target_key] == emove.targets
+    return used, emove, complete
+
+
+def _count_pair(emove_alloc):
+    """Count goal version of _atom_pair"""
+    up, down = CountGoal(), CountGoal()
+    for emove in emove_alloc:
+        up[emove.move[0]] += emove.n_sources
+        down[emove.move[1]] += emove.n_targets
+    return up, down
+
+
+def form_count_pairs(goal1, goal2, same_goal, props):
+    """Count goal version of form_pairs. The distances are computed between the distinct positions of the goals. If
+    same_goal is set, goal1 and goal2 are the same goal"""
+    groups = {}
+    for p in goal1:
+        for q in goal2:
+            dist = (p[0] - q[0], p[1] - q[1], p[2] != q[2])
+            if dist in groups:
+                groups[dist].append((p, q))
+            else:
+                groups[dist] = [(p, q)]
+
+    dists = sorted(groups.keys())
+    if props.short_distance_first:
+        dists.sort(key=lambda x: sum(abs(i) for i in x))
+
+    take = lambda emove, used: _take_count_emove(emove, used, same_goal)
+    for dist in dists:
+        base_cost = distance_cost(dist)
+
+        emoves = []
+        for p, q in groups[dist]:
+            emoves.extend(_count_cluster_emoves(goal1[p], goal2[q], same_goal and p == q, (p, q)))
+
+        for up, down in group_emoves(emoves, props, take, Counter(), _count_pair):
+            n_up, n_down = up.n_atoms(), down.n_atoms()
+            if n_up > n_down:
+                scale_cost = (log2(n_up/n_down)) * operation_cost['double']
+            else:
+                scale_cost = (log2(n_down/n_up)) * operation_cost['div']
+            yield (base_cost + scale_cost, (up, down))
+
+
+def count_pair_overlaps(pair):
+    """Tells if the up and down sets of a count pair (up, down, i, j) are partly the same atoms. This is only the case
+    for pairs of a goal with itself at distance 0, where up and down are at the same positions"""
+    up, down, i, j = pair
+    return i == j and up.keys() == down.keys()
+
+
+def generate_count_pairs(agoals, props):
+    """Count goal version of generate_pairs. The pairs are (cost, (up, down, i, j)), with up taken from goal i and
+    down from goal j"""
+    all_pairs = []
+    for i in range(0, len(agoals)):
+        for j in range(i, len(agoals)):
+            goal1, goal2 = agoals[i], agoals[j]
+            if props.memoize_pairs:
+                key = (frozenset(goal1.items()), frozenset(goal2.items()), i == j, props.short_distance_first,
+                       props.low_scale_first, props.exhaustive, props.line, props.max_sets)
+                pairs = _pair_cache.get(key)
+                if pairs is None:
+                    pairs = list(form_count_pairs(goal1, goal2, i == j, props))
+                    _pair_cache.put(key, pairs)
+            else:
+                pairs = form_count_pairs(goal1, goal2, i == j, props)
+            all_pairs.extend((cost, (up, down, i, j)) for cost, (up, down) in pairs)
+
+    if props.sort_distinct_pos:
+        # the number of distinct positions left after the pair, like distinct_pos_scorer
+        counts = Counter()
+        for goal in agoals:
+            counts.update(goal)
+
+        def score(pair):
+            up, down = pair[0], pair[1]
+            overlaps = count_pair_overlaps(pair)
+            left = len(counts)
+            for pos, n in up.items():
+                if overlaps:
+                    n -= down[pos]
+                if n == counts[pos]:
+                    left -= 1
+            return left
+        all_pairs.sort(key=lambda p: score(p[1]))
+    return all_pairs
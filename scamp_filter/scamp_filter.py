@@ -9,13 +9,41 @@ import scamp_filter.RegAlloc as RegAlloc
 from scamp_filter.costs import operation_cost
 from scamp_filter.Latexer import latexify_goal, print_filter
 from scamp_filter.approx import approx_filter
+from scamp_filter.symmetry import canonical_form, derive_meta_program
+import copy
+import json
 import time
-from scamp_filter.pair_gen import generate_pairs, generate_pairs_gen, translate_back_set, translate_goal
+import numpy as np
+from scamp_filter.pair_gen import generate_pairs, generate_pairs_gen, generate_pairs_merged, translate_back_set, \
+    translate_goal, pair_cache_stats, clear_pair_cache, CountGoal, generate_count_pairs, count_pair_overlaps, AtomTable, \
+    BitGoal
 import random
+import heapq
+import threading
+import multiprocessing
+from itertools import count
 from termcolor import colored
 from math import log2, ceil, floor
+from collections import Counter, deque
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
 
 L_INT = 1e6
+# the transposition table is cleared once it holds this many states, to bound the memory of long searches
+TRANSPOSITION_TABLE_SIZE = 1000000
+# number of search tasks handed out per worker in the parallel search, more tasks balance the load better
+TASKS_PER_WORKER = 4
+# number of plans a search keeps
+PLAN_STORE_SIZE = 8
+# number of states the greedy search for a first plan may expand, before the search goes on without a cost bound
+WARM_START_EXPANSIONS = 200
+
+# cost bound shared between the worker processes of a parallel search, None in a sequential search
+_shared_bound = None
+_shared_expansions = None
+_worker_transpositions = None
 
 class PlanStep:
     def __init__(self, goals, pair):
@@ -26,17 +54,213 @@ class PlanStep:
         return str(self.goals) + '   |   ' + str(self.pair[0]) + ' > ' + str(self.pair[1])
 
 
+class PlanLink:
+    """A plan under construction, as a linked list of its steps in search order. Every plan shares the steps of the
+    plan it was extended from, so extending a plan takes constant time and memory. The empty plan is PlanLink()"""
+    def __init__(self, step=None, parent=None):
+        self.step = step
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+
+    def extend(self, step):
+        return PlanLink(step, self)
+
+    def to_list(self):
+        """Returns the steps in search order"""
+        steps = []
+        link = self
+        while link.parent is not None:
+            steps.append(link.step)
+            link = link.parent
+        return steps[::-1]
+
+    def __len__(self):
+        return self.depth
+
+
+class PlanStore:
+    """Keeps the max_plans cheapest plans (cost, plan) found, whose cost is at most tolerance above the cheapest one.
+    Plans that fall out of this range are dropped as soon as a cheaper plan is found, so a long search does not
+    accumulate all the plans it improved on. Plans of equal cost are kept in the order they were found. A search only
+    looks for plans that improve on the cheapest one, unless near_optimal is set: then it also looks for the plans
+    within tolerance of it, that the store keeps as alternatives"""
+    def __init__(self, max_plans=PLAN_STORE_SIZE, tolerance=0, near_optimal=False):
+        self.max_plans = max_plans
+        self.tolerance = tolerance
+        self.near_optimal = near_optimal
+        self.entries = []
+
+    def cost_bound(self, min_cost):
+        """Returns the cost a branch has to stay below, to lead to plans the search looks for, given the cost of the
+        cheapest plan so far"""
+        # costs are integers, a plan of cost min_cost + tolerance is still kept
+        return min_cost + self.tolerance + 1 if self.near_optimal else min_cost
+
+    def add(self, cost, plan):
+        if self.entries and cost > self.entries[0][0] + self.tolerance:
+            return
+        entries = self.entries + [(cost, plan)]
+        entries.sort(key=lambda x: x[0])
+        limit = entries[0][0] + self.tolerance
+        # replace the list at once, so another thread reading the store always sees a consistent state
+        self.entries = [entry for entry in entries if entry[0] <= limit][:self.max_plans]
+
+    def extend(self, plans):
+        for cost, plan in plans:
+            self.add(cost, plan)
+
+    def best(self):
+        """Returns the cheapest (cost, plan), or None if there is none"""
+        entries = self.entries
+        return entries[0] if entries else None
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class SolutionStats:
     def __init__(self, start_time):
         self.sols = []
         self.start_time = start_time
+        # admissible lower bound on the cost of any plan, and whether the search was stopped by its budget
+        self.lower_bound = 0
+        self.timed_out = False
+        self.expansions = 0
+        self.pair_cache_hits = 0
+        self.pair_cache_misses = 0
+        # where the search budget goes: expanded nodes per depth, pairs generated and explored, the reasons children
+        # were pruned for, the time spent generating pairs (summed over the workers of a parallel search) and in the
+        # search overall, and the peak memory (resident set size in KB)
+        self.nodes_per_depth = Counter()
+        self.pairs_generated = 0
+        self.pairs_explored = 0
+        self.prunes = Counter()
+        self.pair_gen_time = 0.0
+        self.search_time = 0.0
+        self.peak_memory = None
 
     def log_solution(self, cost):
         self.sols.append((time.time()-self.start_time, cost))
 
+    def merge(self, other):
+        """Merges the solutions logged by another search (with the same start time) into this one. The lower bound is
+        left to the caller, as it depends on how the searches relate: the subtrees of a parallel search share the
+        bound of the root, the sequential passes of a separable filter add up theirs"""
+        self.sols.extend(other.sols)
+        self.sols.sort(key=lambda x: x[0])
+        self.timed_out = self.timed_out or other.timed_out
+        self.expansions += other.expansions
+        self.pair_cache_hits += other.pair_cache_hits
+        self.pair_cache_misses += other.pair_cache_misses
+        self.nodes_per_depth.update(other.nodes_per_depth)
+        self.pairs_generated += other.pairs_generated
+        self.pairs_explored += other.pairs_explored
+        self.prunes.update(other.prunes)
+        self.pair_gen_time += other.pair_gen_time
+        self.search_time += other.search_time
+        if other.peak_memory is not None:
+            self.peak_memory = max(self.peak_memory or 0, other.peak_memory)
+
+    def log_pair_cache(self, start_stats):
+        """Adds the pair cache hits and misses since start_stats (taken from pair_cache_stats) to the stats"""
+        hits, misses = pair_cache_stats()
+        self.pair_cache_hits += hits - start_stats[0]
+        self.pair_cache_misses += misses - start_stats[1]
+
+    def pair_cache_hit_rate(self):
+        lookups = self.pair_cache_hits + self.pair_cache_misses
+        return self.pair_cache_hits / lookups if lookups else 0.0
+
+    def best_cost(self):
+        return min((cost for _, cost in self.sols), default=float('inf'))
+
+    def gap(self):
+        """The optimality gap, i.e. how much the best solution found can at most be more expensive than the optimum"""
+        return self.best_cost() - self.lower_bound
+
+    def log_peak_memory(self):
+        if resource is not None:
+            self.peak_memory = max(self.peak_memory or 0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def branching_factor(self):
+        """The average number of pairs generated per expanded node"""
+        return self.pairs_generated / self.expansions if self.expansions else 0.0
+
+    def to_dict(self):
+        best_cost = self.best_cost()
+        return {
+            'solutions': self.sols,
+            'best_cost': None if best_cost == float('inf') else best_cost,
+            'lower_bound': self.lower_bound,
+            'timed_out': self.timed_out,
+            'expansions': self.expansions,
+            'nodes_per_depth': {depth: self.nodes_per_depth[depth] for depth in sorted(self.nodes_per_depth)},
+            'pairs_generated': self.pairs_generated,
+            'pairs_explored': self.pairs_explored,
+            'branching_factor': self.branching_factor(),
+            'prunes': dict(self.prunes),
+            'pair_cache_hits': self.pair_cache_hits,
+            'pair_cache_misses': self.pair_cache_misses,
+            'pair_gen_time': self.pair_gen_time,
+            'search_time': self.search_time,
+            'peak_memory': self.peak_memory,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+class SearchBudget:
+    """Decides when a search has to stop: once max_expansions search nodes have been expanded, once the search time
+    is used up, or when the search got cancelled. Both limits are optional. A search that is only limited by the number
+    of expansions does not depend on the speed of the machine, and always returns the same plans"""
+    def __init__(self, search_time, max_expansions=None):
+        self.end_time = float('inf') if search_time is None else time.time() + search_time
+        self.max_expansions = float('inf') if max_expansions is None else max_expansions
+        self.expansions = 0
+        self.cancelled = False
+        # expansion counter shared by the workers of a parallel search
+        self.shared = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def exhausted(self):
+        expansions = self.expansions if self.shared is None else self.shared.value
+        return self.cancelled or expansions >= self.max_expansions or self.end_time < time.time()
+
+    def expand(self):
+        """Accounts for the expansion of a search node. Returns False, if the budget does not allow any more"""
+        if self.exhausted():
+            return False
+        self.expansions += 1
+        if self.shared is not None:
+            with self.shared.get_lock():
+                self.shared.value += 1
+        return True
+
+
+class RegisterLimit:
+    """The number of registers the goals of a search state may take. The outputs (the final goals of the search) are
+    held in target registers of their own once they are computed, so goals that are still a complete output do not
+    take one of the n_reg registers"""
+    def __init__(self, n_reg, outputs=()):
+        self.n_reg = n_reg
+        self.outputs = tuple(outputs)
+
+    def exceeded(self, goals):
+        if len(goals) <= self.n_reg:
+            return False
+        n_goals = sum(1 for goal in goals
+                      if not any(len(goal) == len(output) and goal == output for output in self.outputs))
+        return n_goals > self.n_reg
+
 
 class PairGenProps:
-    def __init__(self, sort_distinct_pos, short_distance_first, low_scale_first, max_sets, exhaustive, line, generate_all, randomize, log_all=True):
+    def __init__(self, sort_distinct_pos, short_distance_first, low_scale_first, max_sets, exhaustive, line, generate_all, randomize, log_all=True, transposition=True, lower_bound=True, engine='dfs', beam_width=16, heuristic_weight=1.0, vectorized=False, memoize_pairs=True, merge_pairs=False, count_goals=False, bit_goals=False, warm_start=True):
         self.sort_distinct_pos = sort_distinct_pos
         self.short_distance_first = short_distance_first
         self.low_scale_first = low_scale_first
@@ -46,12 +270,33 @@ class PairGenProps:
         self.max_sets = max_sets
         self.randomize = randomize
         self.log_all = log_all
+        self.transposition = transposition
+        self.lower_bound = lower_bound
+        # search engine: 'dfs' (depth first branch and bound), 'best_first' (weighted A*) or 'beam'
+        self.engine = engine
+        self.beam_width = beam_width
+        self.heuristic_weight = heuristic_weight
+        self.vectorized = vectorized
+        self.memoize_pairs = memoize_pairs
+        self.merge_pairs = merge_pairs
+        # search on CountGoals (atom counts per position) instead of sets of atoms
+        self.count_goals = count_goals
+        # search on BitGoals (integer masks over the atoms of the final goals) instead of sets of atoms
+        self.bit_goals = bit_goals
+        # seed the branch and bound search with the cost of a greedily built plan
+        self.warm_start = warm_start
 
 
 
 def _end_state(goal):
     """An end state is reached when all atoms in the goal are at the same position and the number of atoms is a
        multiple of two"""
+    if isinstance(goal, (CountGoal, BitGoal)):
+        counts = _position_counts(goal)
+        if len(counts) != 1:
+            return False
+        number_of_atoms = next(iter(counts.values()))
+        return ceil(log2(number_of_atoms)) == floor(log2(number_of_atoms))
     pivot_atom = next(iter(goal))
     px, py, pneg = pivot_atom.x, pivot_atom.y, pivot_atom.neg
     for a in goal:
@@ -86,10 +331,52 @@ def _not_equal_goals(goals1, goals2):
     return False
 
 
+def _position_counts(goal):
+    """Returns the number of atoms at every position (x, y, neg) of the goal"""
+    if isinstance(goal, CountGoal):
+        return goal
+    if isinstance(goal, BitGoal):
+        return goal.position_counts()
+    return Counter(a.val() for a in goal)
+
+
+def _lower_bound(goals, scale):
+    """Admissible estimate of the cost that is at least needed to generate the goals from the initial state. Every
+    position of a goal is reached from the origin by a chain of moves. This chain costs at least the manhattan distance
+    of the position, and the scale gap between the initial state and the atom count at the position (the same gap
+    _last_cost pays). If the goals are no end state yet, at least one more step with an add is needed as well."""
+    scale_cost = min(operation_cost['div'], operation_cost['double'])
+    bound = 0
+    for goal in goals:
+        for (x, y, _), count in _position_counts(goal).items():
+            chain_cost = (abs(x) + abs(y)) * operation_cost['shift'] + max(scale - floor(log2(count)), 0) * scale_cost
+            bound = max(bound, chain_cost)
+    if len(goals) > 1 or not _end_state(goals[0]):
+        bound += operation_cost['add']
+    return bound
+
+
+def _rank_estimate(goals, bound):
+    """Estimate of the remaining cost that is used to rank the states of a beam. It is not admissible: on top of the
+    lower bound, every distinct position but one is assumed to need its own step (an add and a shift) to be merged"""
+    positions = set()
+    for goal in goals:
+        positions.update(_position_counts(goal))
+    return bound + (len(positions) - 1) * (operation_cost['add'] + operation_cost['shift'])
+
+
+def _canonical_state(goals):
+    """Returns a canonical form of the goals, that ignores the atom ids and the order of the goals. Two states with
+    the same canonical form span identical search trees"""
+    return tuple(sorted(tuple(sorted(_position_counts(goal).items())) for goal in goals))
+
+
 def _generate_initial_state(scale, initial_step):
     """Generates the initial state, making sure that all ids at zero position in the initial step are present"""
     if len(initial_step) != 1:
         raise ValueError('[Error] Initial step should have length 1')
+    if isinstance(initial_step[0], CountGoal):
+        return CountGoal({(0, 0, False): 2 ** scale})
     initial_set = initial_step[0]
     gen_id_start = 1e6
     n_initial = 2 ** scale
@@ -98,50 +385,201 @@ def _generate_initial_state(scale, initial_step):
 
 
 
-def _search(final_goal, n_reg, search_time, scale, pair_props):
-    """Driver function for the search algorithm"""
-    end_time = search_time + time.time()
-    plans = []
+def _search(final_goals, n_reg, budget, scale, pair_props, n_workers=1, plans=None, sol_stats=None):
+    """Driver function for the search algorithm. The search starts from the list final_goals, one goal per output.
+    Plans are added to the PlanStore plans while the search is running"""
+    plans = PlanStore() if plans is None else plans
 
     print(colored('>> Searching for plans...', 'magenta'))
     # we have one less reg available for intermediate results, as we need a reg for shifting in the generation phase
-    sol_stats = SolutionStats(time.time())
-    min_cost = _r_search([final_goal], n_reg, [], plans, 0, float('inf'), end_time, scale, sol_stats, pair_props)
-    for plan in plans:
-        plan[1].reverse()
+    sol_stats = SolutionStats(time.time()) if sol_stats is None else sol_stats
+    sol_stats.lower_bound = _lower_bound(final_goals, scale)
+    pair_cache_start = pair_cache_stats()
+    search_start = time.time()
+    reg_limit = RegisterLimit(n_reg, final_goals)
+    try:
+        if pair_props.engine == 'best_first':
+            _best_first_search(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props)
+        elif pair_props.engine == 'beam':
+            _beam_search(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props)
+        else:
+            # a greedy first plan gives the branch and bound search a cost bound to prune with from the start
+            min_cost = float('inf')
+            if pair_props.warm_start:
+                min_cost = _greedy_search(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props)
+            if n_workers > 1:
+                _search_parallel(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props, n_workers, min_cost)
+            else:
+                transpositions = {}
+                _r_search(final_goals, reg_limit, PlanLink(), plans, 0, min_cost, budget, scale, sol_stats, pair_props, transpositions)
+    finally:
+        # the pairs of this search are not needed anymore, and would only hold memory
+        clear_pair_cache()
+    sol_stats.expansions += budget.expansions
+    sol_stats.search_time += time.time() - search_start
+    sol_stats.log_pair_cache(pair_cache_start)
+    sol_stats.log_peak_memory()
     print(colored('\n...Done', 'yellow'))
+    if sol_stats.timed_out and sol_stats.sols:
+        print(colored('... Search budget used up. Lower bound %d, optimality gap %d' % (sol_stats.lower_bound, sol_stats.gap()),
+                      'yellow'))
     return plans, sol_stats
 
 
-def _r_search(goals, n_reg, plan, plans, cost_acc, min_cost, end_time, scale, sol_stats, pair_props):
-    """Recursive function that searches for all the plans"""
+def _split_tasks(final_goals, n_tasks, reg_limit, budget, pair_props):
+    """Splits the search tree breadth first into subtrees, until there are enough subtrees to feed all workers. A task
+    is the state (goals, plan, cost_acc) a subtree search starts from"""
+    tasks = deque([(final_goals, PlanLink(), 0)])
+    done = []
+    seen = {}
+    while tasks and len(tasks) + len(done) < n_tasks:
+        goals, plan, cost_acc = tasks.popleft()
+        if len(goals) == 1 and _end_state(goals[0]):
+            done.append((goals, plan, cost_acc))
+            continue
+        # once the budget is used up, the state is left to the workers, that stop right away
+        if not budget.expand():
+            tasks.appendleft((goals, plan, cost_acc))
+            break
+        for step_cost, new_goals, pair in _expand(goals, pair_props):
+            if not reg_limit.exceeded(new_goals) and _not_equal_goals(goals, new_goals):
+                # the same state is often reachable through different pairs, only search it once
+                state = _canonical_state(new_goals)
+                if seen.get(state, float('inf')) <= cost_acc + step_cost:
+                    continue
+                seen[state] = cost_acc + step_cost
+                tasks.append((new_goals, plan.extend(PlanStep(goals, pair)), cost_acc + step_cost))
+    return done + list(tasks)
 
-    # if we only have one goal with one item left, we found a solution
-    if len(goals) == 1 and _end_state(goals[0]):
-        total_cost = cost_acc + _last_cost(goals[0], scale)
-        if pair_props.log_all:
-            sol_stats.log_solution(total_cost)
 
-        if total_cost <= min_cost:
-            if not pair_props.log_all:
-                sol_stats.log_solution(total_cost)
-            # append first step to plan
-            plan.append(PlanStep(goals, (_generate_initial_state(scale, goals), goals[0])))
-            plans.append((total_cost, plan))
-            if total_cost < min_cost:
-                print('\r>>> minimum cost found %d ' % total_cost, end='', flush=True)
-            return total_cost
-        return min_cost
+def _init_worker(bound, expansions):
+    global _shared_bound, _shared_expansions, _worker_transpositions
+    _shared_bound = bound
+    _shared_expansions = expansions
+    # a worker keeps its transposition table over all the tasks it searches, as costs are counted from the root
+    _worker_transpositions = {}
+
+
+def _search_task(args):
+    """Searches the subtree of a single task in a worker process"""
+    (goals, plan, cost_acc), reg_limit, budget, scale, pair_props, start_time, store_props = args
+    plans = PlanStore(*store_props)
+    sol_stats = SolutionStats(start_time)
+    # count the expansions of this task only, the limit is checked on the shared counter
+    budget.shared = _shared_expansions
+    budget.expansions = 0
+    pair_cache_start = pair_cache_stats()
+    if not budget.exhausted():
+        _r_search(goals, reg_limit, plan, plans, cost_acc, _shared_bound.value, budget, scale, sol_stats, pair_props,
+                  _worker_transpositions)
+    else:
+        sol_stats.timed_out = True
+    sol_stats.expansions = budget.expansions
+    sol_stats.log_pair_cache(pair_cache_start)
+    sol_stats.log_peak_memory()
+    return plans, sol_stats
+
+
+def _search_parallel(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props, n_workers, min_cost=float('inf')):
+    """Branch and bound search over a pool of worker processes. The search tree is split into subtrees that are
+    searched independently, while all workers share the cost bound of the best solution found so far"""
+    tasks = _split_tasks(final_goals, n_workers * TASKS_PER_WORKER, reg_limit, budget, pair_props)
+    bound = multiprocessing.Value('d', min_cost)
+    # the expansions are counted over all workers, this makes the parallel search nondeterministic
+    expansions = multiprocessing.Value('l', budget.expansions)
+    # the workers look for the same plans as the store of the search keeps
+    store_props = (plans.max_plans, plans.tolerance, plans.near_optimal)
+    args = [(task, reg_limit, budget, scale, pair_props, sol_stats.start_time, store_props) for task in tasks]
+    with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(bound, expansions)) as pool:
+        results = pool.imap_unordered(_search_task, args)
+        for _ in range(len(args)):
+            # the workers do not see a cancellation, the pool is terminated instead
+            while True:
+                if budget.cancelled:
+                    sol_stats.timed_out = True
+                    return
+                try:
+                    task_plans, task_stats = results.next(timeout=0.1)
+                    break
+                except multiprocessing.TimeoutError:
+                    pass
+            plans.extend(task_plans)
+            sol_stats.merge(task_stats)
+
+
+def _publish_bound(cost):
+    """Lowers the cost bound shared with the other workers"""
+    with _shared_bound.get_lock():
+        if cost < _shared_bound.value:
+            _shared_bound.value = cost
+
+
+def _instrumented_pairs(pairs, sol_stats):
+    """Iterates the pairs, and accounts the number of pairs and the time it takes to generate them to sol_stats"""
+    pairs = iter(pairs)
+    while True:
+        start = time.perf_counter()
+        pair = next(pairs, None)
+        sol_stats.pair_gen_time += time.perf_counter() - start
+        if pair is None:
+            return
+        sol_stats.pairs_generated += 1
+        yield pair
+
+
+def _expand_counts(goals, pair_props, sol_stats=None):
+    """Count goal version of _expand. The pairs applied are (up, down, i, j), with up taken from goal i and down
+    from goal j. All pairs of a state are formed at once, as with generate_all, so generate_all, merge_pairs and
+    vectorized have no effect on count goals"""
+    start = time.perf_counter()
+    pairs = generate_count_pairs(goals, pair_props)
+    if pair_props.randomize:
+        random.shuffle(pairs)
+    if sol_stats is not None:
+        sol_stats.pair_gen_time += time.perf_counter() - start
+        pairs = _instrumented_pairs(pairs, sol_stats)
+
+    for cost, pair in pairs:
+        up, down, i, j = pair
+        # if up and down are partly the same atoms, down is a subset of up, and the smaller set is the new goal
+        if count_pair_overlaps(pair):
+            up_set, down_set, removed = down, up, {i: up}
+        elif i == j:
+            up_set, down_set, removed = up, down, {i: up + down}
+        else:
+            up_set, down_set, removed = up, down, {i: up, j: down}
 
-    # compute pairs
+        new_goals = []
+        for k, goal in enumerate(goals):
+            new_goal = goal.subtract_counts(removed[k]) if k in removed else goal
+            if len(new_goal) > 0:
+                new_goals.append(new_goal)
+            # if we generate a rest term, we have to add that one in this step as well
+            step_cost = cost + operation_cost['add'] if len(new_goals) > len(goals) else cost
+
+        new_goals.append(up_set)
+        yield step_cost, new_goals, (up_set, down_set, i, j)
+
+
+def _expand(goals, pair_props, sol_stats=None):
+    """Generates the children of a search state. Yields the cost of the step, the new goals and the pair applied. If
+    sol_stats are given, the pairs generated and the time it takes are accounted to them"""
+    if pair_props.count_goals:
+        yield from _expand_counts(goals, pair_props, sol_stats)
+        return
+    start = time.perf_counter()
     if pair_props.generate_all:
         pairs = generate_pairs(goals, pair_props)
         if pair_props.randomize:
             random.shuffle(pairs)
+    elif pair_props.merge_pairs:
+        pairs = generate_pairs_merged(goals, pair_props)
     else:
         pairs = generate_pairs_gen(goals, pair_props)
+    if sol_stats is not None:
+        sol_stats.pair_gen_time += time.perf_counter() - start
+        pairs = _instrumented_pairs(pairs, sol_stats)
 
-    # choose a pair
     for cost, (up, down) in pairs:
         up_set, down_set = (down, up) if down.issubset(up) else (up, down)
         # compute rests
@@ -155,30 +593,250 @@ def _r_search(goals, n_reg, plan, plans, cost_acc, min_cost, end_time, scale, so
             step_cost = cost + operation_cost['add'] if len(new_goals) > len(goals) else cost
 
         new_goals.append(up_set)
+        yield step_cost, new_goals, (up_set, down_set)
+
+
+def _record_solution(goals, plan, plans, cost_acc, min_cost, scale, sol_stats, pair_props):
+    """Completes the plan of an end state and stores it, if it is not more expensive than the best plan so far.
+    Returns the new minimum cost"""
+    total_cost = cost_acc + _last_cost(goals[0], scale)
+    if pair_props.log_all:
+        sol_stats.log_solution(total_cost)
+
+    if total_cost <= min_cost or total_cost < plans.cost_bound(min_cost):
+        if not pair_props.log_all:
+            sol_stats.log_solution(total_cost)
+        # append first step to plan, and store it in execution order (starting from the initial state)
+        steps = plan.to_list() + [PlanStep(goals, (_generate_initial_state(scale, goals), goals[0]))]
+        plans.add(total_cost, steps[::-1])
+        if total_cost < min_cost:
+            print('\r>>> minimum cost found %d ' % total_cost, end='', flush=True)
+            if _shared_bound is not None:
+                _publish_bound(total_cost)
+        return min(total_cost, min_cost)
+    return min_cost
+
+
+def _r_search(goals, reg_limit, plan, plans, cost_acc, min_cost, budget, scale, sol_stats, pair_props, transpositions):
+    """Recursive function that searches for all the plans"""
+    # in a parallel search, other workers may have found a cheaper solution in the meantime
+    if _shared_bound is not None:
+        min_cost = min(min_cost, _shared_bound.value)
+
+    # if we only have one goal with one item left, we found a solution
+    if len(goals) == 1 and _end_state(goals[0]):
+        return _record_solution(goals, plan, plans, cost_acc, min_cost, scale, sol_stats, pair_props)
+
+    # skip states we already visited with a lower or equal accumulated cost, their subtree has been searched already
+    if pair_props.transposition:
+        state = _canonical_state(goals)
+        if transpositions.get(state, float('inf')) <= cost_acc:
+            sol_stats.prunes['transposition'] += 1
+            return min_cost
+
+    if not budget.expand():
+        sol_stats.timed_out = True
+        return min_cost
+    sol_stats.nodes_per_depth[len(plan)] += 1
+
+    if pair_props.transposition:
+        if len(transpositions) >= TRANSPOSITION_TABLE_SIZE:
+            transpositions.clear()
+        transpositions[state] = cost_acc
+
+    # choose a pair
+    for step_cost, new_goals, pair in _expand(goals, pair_props, sol_stats):
         # only continue to search here, if we can hold this many sub results in registers
-        if len(new_goals) <= n_reg and cost_acc+step_cost < min_cost and _not_equal_goals(goals, new_goals):
-            min_cost = _r_search(new_goals, n_reg, plan + [PlanStep(goals, (up_set, down_set))], plans, cost_acc + step_cost, min_cost, end_time, scale, sol_stats, pair_props)
-            if end_time < time.time():
+        if reg_limit.exceeded(new_goals):
+            sol_stats.prunes['register_limit'] += 1
+        elif cost_acc+step_cost >= plans.cost_bound(min_cost):
+            sol_stats.prunes['cost_bound'] += 1
+        elif not _not_equal_goals(goals, new_goals):
+            sol_stats.prunes['equal_goals'] += 1
+        # cut the branch early, if even the cheapest possible completion can not beat the best solution
+        elif pair_props.lower_bound and min_cost < float('inf') and \
+                cost_acc + step_cost + _lower_bound(new_goals, scale) >= plans.cost_bound(min_cost):
+            sol_stats.prunes['lower_bound'] += 1
+        else:
+            sol_stats.pairs_explored += 1
+            min_cost = _r_search(new_goals, reg_limit, plan.extend(PlanStep(goals, pair)), plans, cost_acc + step_cost, min_cost, budget, scale, sol_stats, pair_props, transpositions)
+            if budget.exhausted():
+                sol_stats.timed_out = True
                 return min_cost
     return min_cost
 
 
-def generate(filter, search_time, available_regs=('A', 'B', 'C'), start_reg='A', target_reg='B', verbose=1, out_format='APRON', pair_props=None, approx_depth=5, max_approx_coeffs=-1):
-    """Generates a SCAMP program for the given filter"""
-    if pair_props is None:
-        pair_props = PairGenProps(
-            sort_distinct_pos=True,
-            short_distance_first=True,
-            low_scale_first=True,
-            exhaustive=False,
-            line=True,
-            generate_all=True,
-            max_sets=True,
-            randomize=False)
+def _greedy_search(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props):
+    """Builds a first plan quickly, by diving depth first and always trying the child with the lowest cost_acc + rank
+    estimate first (a beam of width 1, that backtracks out of dead ends). Gives up after WARM_START_EXPANSIONS
+    expanded states. Returns the cost of the plan, or infinity if none was found"""
+    return _r_greedy(final_goals, PlanLink(), 0, reg_limit, plans, budget, scale, sol_stats, pair_props, set())
 
-    available_regs = list(available_regs)
-    n_reg = len(available_regs) - 1
 
+def _r_greedy(goals, plan, cost_acc, reg_limit, plans, budget, scale, sol_stats, pair_props, visited):
+    if len(goals) == 1 and _end_state(goals[0]):
+        return _record_solution(goals, plan, plans, cost_acc, float('inf'), scale, sol_stats, pair_props)
+
+    state = _canonical_state(goals)
+    if state in visited or len(visited) >= WARM_START_EXPANSIONS or not budget.expand():
+        return float('inf')
+    sol_stats.nodes_per_depth[len(plan)] += 1
+    visited.add(state)
+
+    children = []
+    for step_cost, new_goals, pair in _expand(goals, pair_props, sol_stats):
+        if reg_limit.exceeded(new_goals):
+            sol_stats.prunes['register_limit'] += 1
+        elif not _not_equal_goals(goals, new_goals):
+            sol_stats.prunes['equal_goals'] += 1
+        else:
+            key = cost_acc + step_cost + _rank_estimate(new_goals, _lower_bound(new_goals, scale))
+            children.append((key, len(children), step_cost, new_goals, pair))
+    children.sort(key=lambda c: c[:2])
+
+    for _, _, step_cost, new_goals, pair in children:
+        sol_stats.pairs_explored += 1
+        cost = _r_greedy(new_goals, plan.extend(PlanStep(goals, pair)), cost_acc + step_cost, reg_limit, plans, budget, scale,
+                         sol_stats, pair_props, visited)
+        if cost < float('inf'):
+            return cost
+    return float('inf')
+
+
+def _best_first_search(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props):
+    """Best first search, that always expands the state with the lowest cost_acc + w * estimate. With a weight of 1
+    the estimate is the lower bound, this is A*, and the first end state taken from the frontier is the cheapest plan.
+    Larger weights rank the states by the rank estimate instead, which leads the search to end states much faster.
+    The search then continues to improve the plan until the deadline or until the frontier is exhausted. A greedy
+    first plan is found before, so the search always returns a plan, and prunes with its cost from the start"""
+    weight = pair_props.heuristic_weight
+    tie = count()
+    goals = final_goals
+    bound = _lower_bound(goals, scale)
+    frontier = [(weight * bound, next(tie), bound, 0, goals, PlanLink())]
+    visited = {}
+    min_cost = _greedy_search(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props)
+
+    while frontier:
+        _, _, bound, cost_acc, goals, plan = heapq.heappop(frontier)
+        if cost_acc + bound >= plans.cost_bound(min_cost):
+            continue
+        if len(goals) == 1 and _end_state(goals[0]):
+            min_cost = _record_solution(goals, plan, plans, cost_acc, min_cost, scale, sol_stats, pair_props)
+            if weight <= 1 and not plans.near_optimal:
+                return
+            continue
+
+        state = _canonical_state(goals)
+        if visited.get(state, float('inf')) <= cost_acc:
+            continue
+        if not budget.expand():
+            sol_stats.timed_out = True
+            return
+        sol_stats.nodes_per_depth[len(plan)] += 1
+        visited[state] = cost_acc
+
+        for step_cost, new_goals, pair in _expand(goals, pair_props, sol_stats):
+            if reg_limit.exceeded(new_goals):
+                sol_stats.prunes['register_limit'] += 1
+            elif not _not_equal_goals(goals, new_goals):
+                sol_stats.prunes['equal_goals'] += 1
+            else:
+                new_cost = cost_acc + step_cost
+                # the cost of an end state is known exactly, which keeps A* from returning a plan too early
+                if len(new_goals) == 1 and _end_state(new_goals[0]):
+                    new_bound = _last_cost(new_goals[0], scale)
+                    estimate = new_bound
+                else:
+                    new_bound = _lower_bound(new_goals, scale)
+                    # the lower bound is too weak to lead the search to end states, the rank estimate is not
+                    estimate = new_bound if weight <= 1 else _rank_estimate(new_goals, new_bound)
+                if new_cost + new_bound < plans.cost_bound(min_cost):
+                    sol_stats.pairs_explored += 1
+                    heapq.heappush(frontier, (new_cost + weight * estimate, next(tie), new_bound, new_cost, new_goals,
+                                              plan.extend(PlanStep(goals, pair))))
+                else:
+                    sol_stats.prunes['lower_bound'] += 1
+
+
+def _beam_search(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props):
+    """Searches the tree level by level, and only expands the beam_width states with the lowest cost_acc + w * rank
+    estimate of a level at once. The beam width trades plan quality against search time. The states left out of a beam
+    are kept per level, and expanded once all the deeper levels ran out of states (beam stack search). Like this, dead
+    ends (states that can not be continued within the register limit) do not end the search, and the search goes on
+    improving the plan until the deadline. With warm_start, a greedy first plan is found before, which gives the search
+    a plan even if the beams do not reach an end state within the budget, and a cost bound to prune with"""
+    weight = pair_props.heuristic_weight
+    # every level holds its candidates (key, cost_acc, goals, plan) that were not expanded yet, sorted by key
+    levels = [[(0, 0, final_goals, PlanLink())]]
+    visited = {}
+    min_cost = float('inf')
+    if pair_props.warm_start:
+        min_cost = _greedy_search(final_goals, reg_limit, plans, budget, scale, sol_stats, pair_props)
+
+    while levels:
+        level = levels[-1]
+        beam, levels[-1] = level[:pair_props.beam_width], level[pair_props.beam_width:]
+
+        candidates = {}
+        for _, cost_acc, goals, plan in beam:
+            if cost_acc >= plans.cost_bound(min_cost):
+                continue
+            if len(goals) == 1 and _end_state(goals[0]):
+                min_cost = _record_solution(goals, plan, plans, cost_acc, min_cost, scale, sol_stats, pair_props)
+                continue
+
+            # states are reached again when the search comes back to the levels left out of the beam
+            state = _canonical_state(goals)
+            if visited.get(state, float('inf')) <= cost_acc:
+                continue
+            if not budget.expand():
+                sol_stats.timed_out = True
+                return
+            sol_stats.nodes_per_depth[len(plan)] += 1
+            visited[state] = cost_acc
+
+            for step_cost, new_goals, pair in _expand(goals, pair_props, sol_stats):
+                if reg_limit.exceeded(new_goals):
+                    sol_stats.prunes['register_limit'] += 1
+                elif not _not_equal_goals(goals, new_goals):
+                    sol_stats.prunes['equal_goals'] += 1
+                else:
+                    new_cost = cost_acc + step_cost
+                    bound = _lower_bound(new_goals, scale)
+                    if new_cost + bound >= plans.cost_bound(min_cost):
+                        sol_stats.prunes['lower_bound'] += 1
+                        continue
+                    # keep only the cheapest way to reach a state
+                    state = _canonical_state(new_goals)
+                    if state in candidates and candidates[state][1] <= new_cost:
+                        sol_stats.prunes['transposition'] += 1
+                        continue
+                    sol_stats.pairs_explored += 1
+                    key = new_cost + weight * _rank_estimate(new_goals, bound)
+                    candidates[state] = (key, new_cost, new_goals, plan.extend(PlanStep(goals, pair)))
+
+        if candidates:
+            levels.append(sorted(candidates.values(), key=lambda c: c[0]))
+        # drop the levels that have been expanded completely
+        while levels and not levels[-1]:
+            levels.pop()
+
+
+def _default_pair_props():
+    return PairGenProps(
+        sort_distinct_pos=True,
+        short_distance_first=True,
+        low_scale_first=True,
+        exhaustive=False,
+        line=True,
+        generate_all=True,
+        max_sets=True,
+        randomize=False)
+
+
+def _prepare_goal(filter, approx_depth, max_approx_coeffs, verbose):
+    """Approximates the filter and translates it into the atom goal the search starts from"""
     pre_goal, _ = approx_filter(filter, depth=approx_depth, max_coeff=max_approx_coeffs, verbose=verbose)
 
     scale = max(max(pre_goal, key=lambda i: i.scale).scale, 0)
@@ -189,73 +847,115 @@ def generate(filter, search_time, available_regs=('A', 'B', 'C'), start_reg='A',
         print(pre_goal)
         print(colored('>> Goal with %d atoms..' % len(final_goal), 'yellow'))
         print(latexify_goal(final_goal))
+    return pre_goal, final_goal, scale
 
 
-    plans, sol_stats = _search(final_goal, n_reg=n_reg, search_time=search_time, scale=scale, pair_props=pair_props)
+def _take_atoms(goal, counts, exclude=frozenset()):
+    """Takes the given number of atoms at every position from an atom goal, the ones with the lowest ids first"""
+    atoms = {pos: [] for pos in counts}
+    for a in goal:
+        if a.val() in atoms and a not in exclude:
+            atoms[a.val()].append(a)
+    taken = set()
+    for pos, n in counts.items():
+        taken.update(sorted(atoms[pos], key=lambda a: a.nr)[:n])
+    return taken
 
-    if len(plans) == 0:
-        raise ValueError('[Error] No plans found')
 
-    # sort the plans according to cost
-    cheapest_cost = min(plans, key=lambda x: x[0])[0]
-    best_plans = [plan for plan in plans if plan[0] == cheapest_cost]
-    if verbose > 0:
-        print('... Found %d plans with approx. cost %d ' % (len(best_plans), cheapest_cost))
+def _search_goals(final_goals, pair_props):
+    """Returns the goals the search starts from, as count goals or bit goals if the search works on these"""
+    if pair_props.count_goals:
+        return [CountGoal.from_atoms(goal) for goal in final_goals]
+    if pair_props.bit_goals:
+        table = AtomTable(final_goals)
+        return [BitGoal.from_atoms(goal, table) for goal in final_goals]
+    return final_goals
 
-    if verbose > 1:
-        print(colored('>> Best plan', 'yellow'))
-        for step in best_plans[0][1]:
-            print(step)
 
-    if verbose > 0:
-        print(colored('>> Generating meta programs', 'magenta'))
-    meta_programs = []
-    for i, (_, best_plan) in enumerate(best_plans):
-        if i == 1:
-            break
-        meta_program = MetaProgrammer.generate_meta_program(best_plan)
-        cost = sum(x.cost() for x in meta_program)
-        if verbose > 0:
-            print(colored('| ... Meta program with %d steps generated. Cost: %d' % (len(meta_program), cost), 'yellow'))
+def _decode_plan(plan, final_goals, scale, pair_props):
+    """Translates a plan found on count goals or bit goals into a plan on atom sets, the meta programmer works on"""
+    if pair_props.count_goals:
+        return _replay_count_plan(plan, final_goals, scale)
+    if pair_props.bit_goals:
+        return [PlanStep([set(goal) for goal in step.goals], tuple(set(s) for s in step.pair)) for step in plan]
+    return plan
 
-        meta_program = MetaTransform.eliminate_empty_shifts(meta_program)
 
-        if verbose > 9:
-            Grapher.print_meta_program(meta_program, verbose>10, title='Computational graph before relaxation')
+def _replay_count_plan(plan, final_goals, scale):
+    """Translates a plan found on count goals into a plan on the atom goals final_goals, by applying its steps to
+    the atom goals again. The meta programmer tells the goals of a plan apart by their atoms, which counts can not do,
+    so the atoms (up to 2^scale of them in the initial state) are built once more here. Returns the plan in execution
+    order"""
+    goals = final_goals
+    atom_plan = []
+    # the steps are applied in search order, from the final goals to the initial state
+    for step in plan[:0:-1]:
+        up, down, i, j = step.pair
+        if count_pair_overlaps(step.pair):
+            # up is a subset of down, the atoms with the lowest ids are taken for both
+            down_set = _take_atoms(goals[i], down)
+            up_set = _take_atoms(down_set, up)
+        else:
+            up_set = _take_atoms(goals[i], up)
+            down_set = _take_atoms(goals[j], down, up_set)
+        atom_plan.append(PlanStep(goals, (up_set, down_set)))
 
-        if verbose > 0:
-            print('')
-            print(colored('| >> Relaxing meta program', 'magenta'))
-        while True:
-            meta_program = MetaTransform.relax_same_shift(meta_program, n_reg)
-            meta_program = MetaTransform.relax_rebalance(meta_program, n_reg)
-            new_cost = sum(x.cost() for x in meta_program)
-            if new_cost >= cost:
-                break
-            cost = new_cost
+        eliminator = up_set | down_set
+        goals = [goal.difference(eliminator) for goal in goals]
+        goals = [goal for goal in goals if len(goal) > 0] + [up_set]
 
-        if verbose > 0:
-            print(colored('| ... Done. New cost: %d' % cost, 'yellow'))
+    atom_plan.append(PlanStep(goals, (_generate_initial_state(scale, goals), goals[0])))
+    return atom_plan[::-1]
 
-        meta_programs.append((cost, meta_program))
-        if verbose > 0:
-            print('')
 
-    meta_programs.sort(key=lambda x: x[0])
-    # get the cheapest meta program
-    cost, meta_program = meta_programs[0]
+def _plan_to_meta_program(plan, n_reg, verbose, outputs=None):
+    """Generates the meta program of a plan and relaxes it. Returns the cost and the meta program. If a list outputs
+    is given, the plan computes several goals, and the registers holding them are appended to outputs"""
+    if outputs is None:
+        meta_program = MetaProgrammer.generate_meta_program(plan)
+    else:
+        meta_program = MetaProgrammer.generate_meta_program(plan, outputs)
+        # every output needs a register of its own, copy the ones that are the input or that are shared
+        next_reg = MetaTransform.get_highest_reg_number(meta_program) + 1
+        for i, reg in enumerate(outputs):
+            if reg == 0 or reg in outputs[:i]:
+                meta_program.append(MetaProgrammer.MoveMetaIntstruction(reg, next_reg, 0, (0, 0)))
+                outputs[i] = next_reg
+                next_reg += 1
+    output_regs = () if outputs is None else tuple(outputs)
+    cost = sum(x.cost() for x in meta_program)
     if verbose > 0:
-        print(colored('... Cheapest meta program has cost %d' % cost, 'yellow'))
+        print(colored('| ... Meta program with %d steps generated. Cost: %d' % (len(meta_program), cost), 'yellow'))
+
+    meta_program = MetaTransform.eliminate_empty_shifts(meta_program, output_regs)
 
     if verbose > 9:
-        Grapher.print_meta_program(meta_program, verbose>10, title='Computational graph after relaxation')
-    if verbose > 3:
-        for step in meta_program:
-            print(step)
+        Grapher.print_meta_program(meta_program, verbose>10, title='Computational graph before relaxation')
+
+    if verbose > 0:
+        print('')
+        print(colored('| >> Relaxing meta program', 'magenta'))
+    while True:
+        meta_program = MetaTransform.relax_same_shift(meta_program, n_reg, output_regs)
+        meta_program = MetaTransform.relax_rebalance(meta_program, n_reg, output_regs)
+        meta_program = MetaTransform.optimize_meta_program(meta_program, n_reg, output_regs)
+        new_cost = sum(x.cost() for x in meta_program)
+        if new_cost >= cost:
+            break
+        cost = new_cost
+
+    if verbose > 0:
+        print(colored('| ... Done. New cost: %d' % cost, 'yellow'))
+    return cost, meta_program
+
 
+def _meta_program_to_scamp(meta_program, pre_goal, n_reg, available_regs, start_reg, target_reg, out_format, verbose, output_regs=None):
+    """Allocates the registers of a meta program, generates the SCAMP code and validates it. If output_regs are given,
+    the meta program computes several outputs, and pre_goal and target_reg are lists with the pre goal and the target
+    register of every output"""
     if verbose > 0:
         print(colored('>> Performing register allocation', 'magenta'))
-    meta_program = RegAlloc.alloc(meta_program, n_reg+1, verbose)
+    meta_program = RegAlloc.alloc(meta_program, n_reg+1, verbose, output_regs or ())
     if verbose > 0:
         print(colored('... Done', 'yellow'))
 
@@ -265,8 +965,14 @@ def generate(filter, search_time, available_regs=('A', 'B', 'C'), start_reg='A',
 
     if verbose > 0:
         print(colored('>> Generating SCAMP code', 'magenta'))
-    program, program_length = ScampProgrammer.generate_scamp_program(meta_program, available_regs, start_reg,
-                                                                     target_reg, out_format)
+    if output_regs is None:
+        program, program_length = ScampProgrammer.generate_scamp_program(meta_program, list(available_regs),
+                                                                         start_reg, target_reg, out_format)
+        outputs = [(target_reg, pre_goal)]
+    else:
+        program, program_length = ScampProgrammer.generate_scamp_program(meta_program, list(available_regs),
+                                                                         start_reg, None, out_format, target_reg)
+        outputs = list(zip(target_reg, pre_goal))
     if verbose > 0:
         print(colored('... SCAMP code with %d instructions generated' % program_length, 'yellow'))
 
@@ -277,11 +983,452 @@ def generate(filter, search_time, available_regs=('A', 'B', 'C'), start_reg='A',
     if verbose > 0:
         print(colored('>> Validating SCAMP code', 'magenta'))
     # validate
-    if Simulator.validate(program, pre_goal, start_reg, target_reg, out_format):
-        if verbose > 0:
-            print(colored('\U0001F37A Validation succeeded', 'green'))
+    for output_reg, output_pre_goal in outputs:
+        if Simulator.validate(program, output_pre_goal, start_reg, output_reg, out_format):
+            if verbose > 0:
+                print(colored('\U0001F37A Validation succeeded', 'green'))
+        else:
+            print(colored('\U0000274C Validation failed!', 'red'))
+            raise AssertionError('[Error] Code validation failed')
+
+    return program, program_length
+
+
+def _search_best_plans(final_goals, n_reg, budget, scale, pair_props, n_workers, verbose, top_k=1, plan_tolerance=0):
+    """Searches plans for the goals. Returns the top_k cheapest plans found, whose cost is at most plan_tolerance above
+    the cheapest one, cheapest first and translated into plans on atom sets, and the search stats"""
+    # with several plans to compile, the search looks for alternatives to the cheapest plan as well
+    plans = PlanStore(max(top_k, PLAN_STORE_SIZE), plan_tolerance, near_optimal=top_k > 1)
+    plans, sol_stats = _search(_search_goals(final_goals, pair_props), n_reg, budget, scale, pair_props, n_workers,
+                               plans)
+
+    if len(plans) == 0:
+        raise ValueError('[Error] No plans found')
+
+    cheapest_cost = plans.best()[0]
+    if verbose > 0:
+        print('... Found %d plans with approx. cost %d ' % (sum(1 for cost, _ in plans if cost == cheapest_cost),
+                                                           cheapest_cost))
+
+    if verbose > 1:
+        print(colored('>> Best plan', 'yellow'))
+        for step in plans.best()[1]:
+            print(step)
+
+    best_plans = [_decode_plan(plan, final_goals, scale, pair_props) for _, plan in list(plans)[:top_k]]
+    return best_plans, sol_stats
+
+
+def _search_meta_program(final_goals, n_reg, budget, scale, pair_props, n_workers, verbose, outputs=None):
+    """Searches plans for the goals, and returns the relaxed meta program of the cheapest one and the search stats.
+    If a list outputs is given, the registers holding the goals are appended to it"""
+    best_plans, sol_stats = _search_best_plans(final_goals, n_reg, budget, scale, pair_props, n_workers, verbose)
+
+    if verbose > 0:
+        print(colored('>> Generating meta programs', 'magenta'))
+    cost, meta_program = _plan_to_meta_program(best_plans[0], n_reg, verbose, outputs)
+    if verbose > 0:
+        print('')
+        print(colored('... Cheapest meta program has cost %d' % cost, 'yellow'))
+    return meta_program, sol_stats
+
+
+def _compile_plan(args):
+    """Relaxes the meta program of a plan, allocates its registers and generates the SCAMP code. Returns the program
+    length, the program and the relaxed meta program before the allocation, or None if the registers can not be
+    allocated or the program fails validation"""
+    plan, pre_goal, n_reg, available_regs, start_reg, target_reg, out_format, verbose = args
+    try:
+        _, meta_program = _plan_to_meta_program(plan, n_reg, verbose)
+        relaxed = copy.deepcopy(meta_program)
+        program, program_length = _meta_program_to_scamp(meta_program, pre_goal, n_reg, available_regs, start_reg,
+                                                         target_reg, out_format, verbose)
+    except (AssertionError, ValueError) as e:
+        print(colored('... Skipping a plan: %s' % e, 'red'))
+        return None
+    return program_length, program, relaxed
+
+
+def _compile_best_plan(plans, pre_goal, n_reg, available_regs, start_reg, target_reg, out_format, verbose, n_workers):
+    """Compiles all the plans, over a pool of n_workers processes, and returns (program_length, program, meta program)
+    of the shortest SCAMP program. Relaxation changes the costs, so the cheapest plan does not always give the
+    shortest program. On equal lengths the cheaper plan is taken. Plans that can not be compiled are skipped, an error
+    is only raised if none of them can"""
+    if verbose > 0:
+        print(colored('>> Compiling the %d best plans' % len(plans), 'magenta'))
+    args = [(plan, pre_goal, n_reg, available_regs, start_reg, target_reg, out_format, verbose) for plan in plans]
+    if n_workers > 1 and len(plans) > 1:
+        with multiprocessing.Pool(min(n_workers, len(plans))) as pool:
+            results = pool.map(_compile_plan, args)
     else:
-        print(colored('\U0000274C Validation failed!', 'red'))
-        raise AssertionError('[Error] Code validation failed')
+        results = [_compile_plan(arg) for arg in args]
+    compiled = [i for i, result in enumerate(results) if result is not None]
+    if not compiled:
+        raise ValueError('[Error] None of the %d best plans could be compiled' % len(plans))
+    best = min(compiled, key=lambda i: results[i][0])
+    if verbose > 0:
+        print(colored('... Program lengths %s, taking plan %d' % ([r and r[0] for r in results], best), 'yellow'))
+    return results[best]
+
+
+def _separate(filter, approx_depth, max_approx_coeffs):
+    """Splits a separable (rank 1) filter into a column and a row filter. The approximations of the two convolved
+    have to give exactly the approximation of the filter. Returns None if there is no such split"""
+    filter = np.asarray(filter, dtype=np.float64)
+    if filter.ndim != 2 or min(filter.shape) < 2:
+        return None
+    _, approximated = approx_filter(filter, depth=approx_depth, max_coeff=max_approx_coeffs)
+    # a split is defined by a pivot coefficient, try them all, as only some give splits that can be approximated
+    for y, x in zip(*np.nonzero(approximated)):
+        column = approximated[:, x:x+1]
+        row = approximated[y:y+1, :] / approximated[y, x]
+        if np.count_nonzero(column) < 2 or np.count_nonzero(row) < 2:
+            return None
+        _, approximated_column = approx_filter(column, depth=approx_depth, max_coeff=max_approx_coeffs)
+        _, approximated_row = approx_filter(row, depth=approx_depth, max_coeff=max_approx_coeffs)
+        if np.array_equal(approximated_column @ approximated_row, approximated):
+            return column, row
+    return None
+
+
+def _concatenate_meta_programs(first, second):
+    """Returns a meta program that applies second to the result of first. The registers of second are renumbered
+    to follow the ones of first, its start register becomes the target of first"""
+    offset = MetaTransform.get_highest_reg_number(first)
+    reg_map = lambda reg: first[-1].target if reg == 0 else reg + offset
+    for instr in second:
+        instr.source, instr.target = reg_map(instr.source), reg_map(instr.target)
+        if isinstance(instr, MetaProgrammer.AddMetaInstruction):
+            instr.source2 = reg_map(instr.source2)
+    return first + second
+
+
+def _search_separable(passes, n_reg, search_time, max_expansions, pair_props, n_workers, approx_depth,
+                      max_approx_coeffs, verbose):
+    """Searches a vertical and a horizontal pass independently, each with half of the budget, and concatenates
+    their meta programs. Returns the meta program and the merged stats of both searches, with the sum of the costs of
+    the cheapest plans of the passes as the only solution"""
+    if verbose > 0:
+        print(colored('>> Filter is separable, searching a vertical and a horizontal pass', 'magenta'))
+    meta_program, sol_stats = [], SolutionStats(time.time())
+    cost = 0
+    for pass_filter in passes:
+        budget = SearchBudget(None if search_time is None else search_time / 2,
+                              None if max_expansions is None else max_expansions // 2)
+        _, final_goal, scale = _prepare_goal(pass_filter, approx_depth, max_approx_coeffs, verbose)
+        pass_meta_program, pass_stats = _search_meta_program([final_goal], n_reg, budget, scale, pair_props,
+                                                             n_workers, verbose)
+        meta_program = _concatenate_meta_programs(meta_program, pass_meta_program) if meta_program \
+            else pass_meta_program
+        sol_stats.merge(pass_stats)
+        # the passes are applied one after the other, so the program costs at least the sum of their bounds
+        sol_stats.lower_bound += pass_stats.lower_bound
+        cost += pass_stats.best_cost()
+    # a solution of a single pass is no solution of the filter, only the combined plan of both passes is
+    sol_stats.sols = []
+    sol_stats.log_solution(cost)
+    return meta_program, sol_stats
+
+
+def generate(filter, search_time, available_regs=('A', 'B', 'C'), start_reg='A', target_reg='B', verbose=1, out_format='APRON', pair_props=None, approx_depth=5, max_approx_coeffs=-1, n_workers=1, max_expansions=None, cache=None, symmetry_store=None, separable=False, top_k=1, plan_tolerance=0):
+    """Generates a SCAMP program for the given filter. If a KernelCache is given, the program is taken from the
+    cache if the same filter was compiled with the same parameters before. If a symmetry_store (a dict) is given, the
+    meta programs of compiled filters are kept in it, and filters that are rotations, mirrorings, negations or power
+    of two scalings of a stored one are derived from it without a search. If separable is set, separable filters
+    are compiled as a vertical pass followed by a horizontal pass. With top_k > 1, the top_k cheapest plans within
+    plan_tolerance of the cheapest one are all compiled, over n_workers processes, and the shortest program is kept"""
+    if pair_props is None:
+        pair_props = _default_pair_props()
+
+    available_regs = list(available_regs)
+    n_reg = len(available_regs) - 1
 
+    if cache is not None:
+        cache_key = cache.key(filter, search_time=search_time, max_expansions=max_expansions,
+                              available_regs=available_regs, start_reg=start_reg, target_reg=target_reg,
+                              out_format=out_format, pair_props=pair_props, approx_depth=approx_depth,
+                              max_approx_coeffs=max_approx_coeffs, separable=separable, top_k=top_k,
+                              plan_tolerance=plan_tolerance)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if verbose > 0:
+                print(colored('>> Program taken from the kernel cache', 'yellow'))
+            program, program_length, sol_stats, meta_program = cached
+            if symmetry_store is not None:
+                # the symmetric filters of a cached one are derived from it, as if it had been searched
+                pre_goal, _ = approx_filter(filter, depth=approx_depth, max_coeff=max_approx_coeffs)
+                symmetry_key, transform, neg, sym_scale = canonical_form(pre_goal)
+                symmetry_store.setdefault((n_reg, symmetry_key), (meta_program, transform, neg, sym_scale))
+            return program, program_length, sol_stats
+
+    pre_goal, final_goal, scale = _prepare_goal(filter, approx_depth, max_approx_coeffs, verbose)
+
+    if symmetry_store is not None:
+        symmetry_key, transform, neg, sym_scale = canonical_form(pre_goal)
+        symmetry_key = (n_reg, symmetry_key)
+        if symmetry_key in symmetry_store:
+            if verbose > 0:
+                print(colored('>> Deriving the program from a symmetric filter', 'magenta'))
+            meta_program = derive_meta_program(symmetry_store[symmetry_key], transform, neg, sym_scale)
+            relaxed = copy.deepcopy(meta_program)
+            program, program_length = _meta_program_to_scamp(meta_program, pre_goal, n_reg, available_regs,
+                                                             start_reg, target_reg, out_format, verbose)
+            sol_stats = SolutionStats(time.time())
+            if cache is not None:
+                cache.put(cache_key, (program, program_length, sol_stats, relaxed))
+            return program, program_length, sol_stats
+
+    program = None
+    passes = _separate(filter, approx_depth, max_approx_coeffs) if separable else None
+    if passes is not None:
+        meta_program, sol_stats = _search_separable(passes, n_reg, search_time, max_expansions, pair_props, n_workers,
+                                                    approx_depth, max_approx_coeffs, verbose)
+    elif top_k > 1:
+        plans, sol_stats = _search_best_plans([final_goal], n_reg, SearchBudget(search_time, max_expansions), scale,
+                                              pair_props, n_workers, verbose, top_k, plan_tolerance)
+        program_length, program, meta_program = _compile_best_plan(plans, pre_goal, n_reg, available_regs, start_reg,
+                                                                   target_reg, out_format, verbose, n_workers)
+    else:
+        meta_program, sol_stats = _search_meta_program([final_goal], n_reg, SearchBudget(search_time, max_expansions),
+                                                       scale, pair_props, n_workers, verbose)
+
+    if verbose > 9:
+        Grapher.print_meta_program(meta_program, verbose>10, title='Computational graph after relaxation')
+    if verbose > 3:
+        for step in meta_program:
+            print(step)
+
+    # register allocation works in place, store a copy
+    relaxed = copy.deepcopy(meta_program)
+    if symmetry_store is not None:
+        symmetry_store[symmetry_key] = (relaxed, transform, neg, sym_scale)
+
+    if program is None:
+        program, program_length = _meta_program_to_scamp(meta_program, pre_goal, n_reg, available_regs, start_reg,
+                                                         target_reg, out_format, verbose)
+    if cache is not None:
+        # the relaxed meta program is cached as well, to fill the symmetry store on a cache hit
+        cache.put(cache_key, (program, program_length, sol_stats, relaxed))
     return program, program_length, sol_stats
+
+
+def generate_multi(filters, search_time, available_regs=('A', 'B', 'C'), start_reg='A', target_regs=('B', 'D'), verbose=1, out_format='APRON', pair_props=None, approx_depth=5, max_approx_coeffs=-1, n_workers=1, max_expansions=None):
+    """Generates a single SCAMP program that applies several filters to the same input, and writes the result of
+    filters[i] to target_regs[i]. The filters are searched jointly, so intermediate results are shared between them.
+    The target registers hold the results from the instruction computing them on, so they can not be available or
+    start registers, and the outputs do not take any of the available registers. The filters are compiled one by one
+    as well (with the same budget each), and the joint program is only returned if it is shorter than the programs
+    of the single filters one after the other. The stats are the ones of the joint search"""
+    if len(filters) != len(target_regs):
+        raise ValueError('[Error] Every filter needs a target register')
+    if len(set(target_regs)) != len(target_regs) or set(target_regs) & (set(available_regs) | {start_reg}):
+        raise ValueError('[Error] The target registers have to be distinct from each other, the available registers '
+                         'and the start register')
+    if pair_props is None:
+        pair_props = _default_pair_props()
+
+    available_regs = list(available_regs)
+    n_reg = len(available_regs) - 1
+
+    if verbose > 0:
+        print(colored('>> Approximating %d filters' % len(filters), 'magenta'))
+    pre_goals = [approx_filter(filter, depth=approx_depth, max_coeff=max_approx_coeffs)[0] for filter in filters]
+
+    # all goals are translated with the same scale, and get disjoint atom ids
+    scale = max(max(item.scale for pre_goal in pre_goals for item in pre_goal), 0)
+    final_goals, nr = [], 0
+    for pre_goal in pre_goals:
+        goal, nr = translate_goal(pre_goal, scale, nr)
+        final_goals.append(goal)
+    if verbose > 0:
+        print(colored('>> Goals with %s atoms..' % ', '.join(str(len(goal)) for goal in final_goals), 'yellow'))
+
+    try:
+        outputs = []
+        meta_program, sol_stats = _search_meta_program(final_goals, n_reg, SearchBudget(search_time, max_expansions),
+                                                       scale, pair_props, n_workers, verbose, outputs)
+        if verbose > 3:
+            for step in meta_program:
+                print(step)
+        program, program_length = _meta_program_to_scamp(meta_program, pre_goals, n_reg, available_regs, start_reg,
+                                                         list(target_regs), out_format, verbose, outputs)
+    except ValueError:
+        program, program_length, sol_stats = None, float('inf'), SolutionStats(time.time())
+
+    single = _generate_one_by_one(filters, search_time, available_regs, start_reg, target_regs, verbose, out_format,
+                                  pair_props, approx_depth, max_approx_coeffs, n_workers, max_expansions, pre_goals)
+    if single is not None and single[1] < program_length:
+        if verbose > 0:
+            print(colored('>> Compiling the filters one by one gives a shorter program (%d instead of %s instructions)'
+                          % (single[1], program_length), 'yellow'))
+        program, program_length = single
+    if program is None:
+        raise ValueError('[Error] No program found for %d filters with the available registers %s, neither jointly '
+                         'nor one by one' % (len(filters), available_regs))
+    return program, program_length, sol_stats
+
+
+def _generate_one_by_one(filters, search_time, available_regs, start_reg, target_regs, verbose, out_format, pair_props,
+                         approx_depth, max_approx_coeffs, n_workers, max_expansions, pre_goals):
+    """Compiles the filters of generate_multi one by one, and concatenates their programs. A program must neither
+    overwrite the input nor the results of the ones before, so it can use the available registers except for the
+    start register (unless it is the last one), and the target registers of the filters after it. Returns (program,
+    program_length), or None if a filter can not be compiled"""
+    program, program_length = [], 0
+    for i, filter in enumerate(filters):
+        if i == len(filters) - 1:
+            regs = list(available_regs)
+        else:
+            regs = [reg for reg in available_regs if reg != start_reg] + list(target_regs[i+1:])
+        if len(regs) < 2:
+            return None
+        try:
+            filter_program, filter_length, _ = generate(filter, search_time, regs, start_reg, target_regs[i], verbose,
+                                                        out_format, pair_props, approx_depth, max_approx_coeffs,
+                                                        n_workers, max_expansions)
+        except ValueError:
+            return None
+        program, program_length = program + filter_program, program_length + filter_length
+
+    for target_reg, pre_goal in zip(target_regs, pre_goals):
+        if not Simulator.validate(program, pre_goal, start_reg, target_reg, out_format):
+            raise AssertionError('[Error] Code validation failed')
+    return program, program_length
+
+
+def generate_iter(filter, search_time=None, available_regs=('A', 'B', 'C'), start_reg='A', target_reg='B', verbose=1, out_format='APRON', pair_props=None, approx_depth=5, max_approx_coeffs=-1, n_workers=1, max_expansions=None, poll_interval=0.01):
+    """Anytime variant of generate. The search runs in the background, and every time it finds a plan that is cheaper
+    than the ones before, a validated SCAMP program is generated for it and yielded as (program, program_length,
+    sol_stats). Without a search_time or max_expansions, the search runs until it is exhausted. Closing the generator (or leaving the
+    loop over it) cancels the search. Like generate, it raises a ValueError if the search ends without a plan, and
+    raises the errors of the search"""
+    if pair_props is None:
+        pair_props = _default_pair_props()
+
+    available_regs = list(available_regs)
+    n_reg = len(available_regs) - 1
+
+    pre_goal, final_goal, scale = _prepare_goal(filter, approx_depth, max_approx_coeffs, verbose)
+
+    budget = SearchBudget(search_time, max_expansions)
+    plans, sol_stats = PlanStore(), SolutionStats(time.time())
+    search_goals = _search_goals([final_goal], pair_props)
+    errors = []
+
+    def run_search():
+        try:
+            _search(search_goals, n_reg, budget, scale, pair_props, n_workers, plans, sol_stats)
+        except BaseException as e:
+            errors.append(e)
+
+    search = threading.Thread(target=run_search, daemon=True)
+    search.start()
+
+    min_cost = float('inf')
+    try:
+        while True:
+            # check for the end of the search before looking at the plans, so no plan found at the end is missed
+            searching = search.is_alive()
+            best = plans.best()
+            if best is not None and best[0] < min_cost:
+                min_cost, plan = best
+                plan = _decode_plan(plan, [final_goal], scale, pair_props)
+                _, meta_program = _plan_to_meta_program(plan, n_reg, verbose)
+                program, program_length = _meta_program_to_scamp(meta_program, pre_goal, n_reg, available_regs,
+                                                                 start_reg, target_reg, out_format, verbose)
+                yield program, program_length, sol_stats
+            elif not searching:
+                break
+            else:
+                search.join(poll_interval)
+    finally:
+        budget.cancel()
+        search.join()
+
+    if errors:
+        raise errors[0]
+    if min_cost == float('inf'):
+        raise ValueError('[Error] No plans found')
+
+
+def _pre_goal_key(filter, approx_depth, max_approx_coeffs):
+    """Approximates the filter and returns a normalised key of its pre goal. Pre goals that only differ in how the
+    coefficients are split into items (e.g. 2 - 1 and 1) translate to the same goal, and get the same key"""
+    pre_goal, _ = approx_filter(filter, depth=approx_depth, max_coeff=max_approx_coeffs)
+    scale = max(max(pre_goal, key=lambda i: i.scale).scale, 0)
+    goal, _ = translate_goal(pre_goal, scale)
+    return scale, _canonical_state([goal])
+
+
+def _symmetry_key(filter, approx_depth, max_approx_coeffs, n_reg):
+    """Returns the key of the filter in a symmetry store"""
+    pre_goal, _ = approx_filter(filter, depth=approx_depth, max_coeff=max_approx_coeffs)
+    return n_reg, canonical_form(pre_goal)[0]
+
+
+def _generate_timed(args):
+    """Compiles a single filter of a batch, returns the result of generate, the time it took and the symmetry store
+    that was used"""
+    filter, search_time, kwargs = args
+    start_time = time.time()
+    program, program_length, sol_stats = generate(filter, search_time, **kwargs)
+    return program, program_length, sol_stats, time.time() - start_time, kwargs['symmetry_store']
+
+
+def generate_many(filters, search_time, available_regs=('A', 'B', 'C'), start_reg='A', target_reg='B', verbose=0, out_format='APRON', pair_props=None, approx_depth=5, max_approx_coeffs=-1, max_expansions=None, cache=None, n_processes=None, symmetry_store=None):
+    """Generates SCAMP programs for a batch of filters. Filters that approximate to the same goal are compiled only
+    once, the unique ones are spread over a pool of n_processes processes (all cores by default). Returns a list with
+    (program, program_length, sol_stats, compile_time) for every filter, in the order of the filters. Filters with the
+    same goal share the result and the compile time. If a symmetry_store is given, only one filter of every group of
+    rotated, mirrored, negated or scaled filters is searched, the others are derived from it afterwards"""
+    kwargs = dict(available_regs=available_regs, start_reg=start_reg, target_reg=target_reg, verbose=verbose,
+                  out_format=out_format, pair_props=pair_props, approx_depth=approx_depth,
+                  max_approx_coeffs=max_approx_coeffs, max_expansions=max_expansions, cache=cache)
+
+    # deduplicate the filters by their goal
+    unique = {}
+    keys = []
+    for filter in filters:
+        key = _pre_goal_key(filter, approx_depth, max_approx_coeffs)
+        if key not in unique:
+            unique[key] = len(unique)
+        keys.append(key)
+    unique_filters = [None] * len(unique)
+    for filter, key in zip(filters, keys):
+        if unique_filters[unique[key]] is None:
+            unique_filters[unique[key]] = filter
+
+    # split the unique filters into the ones to search, and the ones to derive from a symmetric one
+    searched, derived = list(range(len(unique_filters))), []
+    if symmetry_store is not None:
+        n_reg = len(available_regs) - 1
+        searched, classes = [], set(symmetry_store)
+        for i, filter in enumerate(unique_filters):
+            key = _symmetry_key(filter, approx_depth, max_approx_coeffs, n_reg)
+            if key in classes:
+                derived.append(i)
+            else:
+                classes.add(key)
+                searched.append(i)
+
+    if verbose > 0:
+        print(colored('>> Compiling %d unique of %d filters' % (len(searched), len(keys)), 'magenta'))
+
+    # every search fills its own symmetry store, they are merged afterwards
+    args = [(unique_filters[i], search_time, dict(kwargs, symmetry_store={})) for i in searched]
+    if n_processes == 1:
+        searched_results = [_generate_timed(a) for a in args]
+    else:
+        # the search of each filter runs on a single core, the pool processes can not start workers on their own
+        with multiprocessing.Pool(n_processes) as pool:
+            searched_results = pool.map(_generate_timed, args, chunksize=1)
+
+    results = [None] * len(unique_filters)
+    for i, result in zip(searched, searched_results):
+        results[i] = result[:4]
+        if symmetry_store is not None:
+            symmetry_store.update(result[4])
+    for i in derived:
+        results[i] = _generate_timed((unique_filters[i], search_time, dict(kwargs, symmetry_store=symmetry_store)))[:4]
+
+    return [results[unique[key]] for key in keys]
@@ -0,0 +1,112 @@
+import copy
+from .Item import Item as I
+from .MetaProgrammer import AddMetaInstruction, MoveMetaIntstruction
+
+# the 8 rotations and mirrorings of the grid, as matrices (a, b, c, d) mapping (x, y) to (a*x + b*y, c*x + d*y)
+TRANSFORMS = [
+    (1, 0, 0, 1),    # identity
+    (0, -1, 1, 0),   # rotation by 90 degrees
+    (-1, 0, 0, -1),  # rotation by 180 degrees
+    (0, 1, -1, 0),   # rotation by 270 degrees
+    (-1, 0, 0, 1),   # mirror at the y axis
+    (1, 0, 0, -1),   # mirror at the x axis
+    (0, 1, 1, 0),    # mirror at the diagonal
+    (0, -1, -1, 0),  # mirror at the anti diagonal
+]
+
+
+def apply_transform(t, x, y):
+    a, b, c, d = t
+    return a*x + b*y, c*x + d*y
+
+
+def compose(t1, t2):
+    """Returns the transform that applies t2 first and t1 afterwards"""
+    a1, b1, c1, d1 = t1
+    a2, b2, c2, d2 = t2
+    return a1*a2 + b1*c2, a1*b2 + b1*d2, c1*a2 + d1*c2, c1*b2 + d1*d2
+
+
+def invert(t):
+    """All transforms are orthogonal, the inverse is the transpose"""
+    a, b, c, d = t
+    return a, c, b, d
+
+
+def transform_pre_goal(pre_goal, t, neg, scale):
+    """Rotates/mirrors a pre goal by t, negates it if neg, and scales it by 2^-scale"""
+    items = []
+    for item in pre_goal:
+        x, y = apply_transform(t, item.x, item.y)
+        items.append(I(item.scale + scale, x, y, item.neg != neg))
+    return items
+
+
+def canonical_form(pre_goal):
+    """Returns a key that is the same for all pre goals that are rotations, mirrorings, negations or power of two
+    scalings of each other. Returns (key, t, neg, scale), where transform_pre_goal(pre_goal, t, neg, scale) is the
+    canonical pre goal the key is formed of"""
+    scale = -min(item.scale for item in pre_goal)
+    best = None
+    for t in TRANSFORMS:
+        for neg in (False, True):
+            items = transform_pre_goal(pre_goal, t, neg, scale)
+            key = tuple(sorted((item.scale, item.x, item.y, item.neg) for item in items))
+            if best is None or key < best[0]:
+                best = (key, t, neg, scale)
+    return best
+
+
+def _fold_scale(meta_program, scale):
+    """Scales a meta program by 2^-scale by scaling its input instead of its result: a meta program is linear in the
+    input, so the scale is added to all the moves reading the input register. Only possible if no add reads the input
+    directly. Returns the scaled copy, or None"""
+    for instr in meta_program:
+        if instr.target == 0 or isinstance(instr, AddMetaInstruction) and 0 in (instr.source, instr.source2):
+            return None
+    meta_program = copy.deepcopy(meta_program)
+    for instr in meta_program:
+        if instr.source == 0:
+            instr.scale += scale
+    return meta_program
+
+
+def transform_meta_program(meta_program, t, neg, scale):
+    """Returns a copy of the meta program, that computes the result of the original one rotated/mirrored by t,
+    negated if neg and scaled by 2^-scale. The transform is applied to the shifts of all moves. The negation is
+    applied to the final instruction: a final move takes it over directly, a final add is negated by negating both of
+    its operands. The scaling is applied to the final instruction as well (a final add is followed by a move for it),
+    or to the moves reading the input, whichever is cheaper. Derived scaled programs can still be longer than
+    searched ones"""
+    meta_program = copy.deepcopy(meta_program)
+    for instr in meta_program:
+        if isinstance(instr, MoveMetaIntstruction):
+            instr.shift = apply_transform(t, *instr.shift)
+
+    last = meta_program[-1]
+    if isinstance(last, MoveMetaIntstruction):
+        last.neg = last.neg != neg
+    elif neg:
+        last.s1neg, last.s2neg = not last.s1neg, not last.s2neg
+    if scale == 0:
+        return meta_program
+
+    folded = _fold_scale(meta_program, scale)
+    if isinstance(last, MoveMetaIntstruction):
+        last.scale += scale
+    else:
+        target = max(max(instr.source, instr.target) for instr in meta_program) + 1
+        for instr in meta_program:
+            if isinstance(instr, AddMetaInstruction):
+                target = max(target, instr.source2 + 1)
+        meta_program.append(MoveMetaIntstruction(last.target, target, scale, (0, 0)))
+    if folded is not None and sum(x.cost() for x in folded) < sum(x.cost() for x in meta_program):
+        return folded
+    return meta_program
+
+
+def derive_meta_program(entry, t, neg, scale):
+    """Derives the meta program of a pre goal from a stored entry (meta_program, t, neg, scale) of an equivalent pre
+    goal. Both (t, neg, scale) tuples map the respective pre goal to the same canonical pre goal"""
+    meta_program, stored_t, stored_neg, stored_scale = entry
+    return transform_meta_program(meta_program, compose(invert(t), stored_t), neg != stored_neg, stored_scale - scale)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from scamp_filter.approx import approx_filter
+from scamp_filter.pair_gen import translate_goal, form_pairs, generate_pairs, generate_pairs_merged, distinct_pos, \
+    distinct_pos_scorer, AtomTable, BitGoal
+from scamp_filter.scamp_filter import _default_pair_props
+
+FILTERS = [
+    np.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]]) / 16,
+    np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]]),
+    np.array([[0, 1, 0], [1, -4, 1], [0, 1, 0]]),
+]
+
+
+def _goals(filter):
+    """The goal of the filter, and a state of two goals it is split into"""
+    pre_goal, _ = approx_filter(filter, depth=4)
+    goal, _ = translate_goal(pre_goal, max(max(item.scale for item in pre_goal), 0))
+    atoms = sorted(goal, key=lambda a: a.nr)
+    return [[goal], [set(atoms[:len(atoms)//2]), set(atoms[len(atoms)//2:])]]
+
+
+def _key(pair):
+    cost, (up, down) = pair
+    return cost, frozenset(up), frozenset(down)
+
+
+@pytest.mark.parametrize('filter', FILTERS)
+@pytest.mark.parametrize('sort_distinct_pos', [False, True])
+def test_merged_pairs_are_generate_pairs_in_global_order(filter, sort_distinct_pos):
+    props = _default_pair_props()
+    props.sort_distinct_pos = sort_distinct_pos
+    for goals in _goals(filter):
+        pairs = generate_pairs(goals, props)
+        merged = list(generate_pairs_merged(goals, props))
+        assert sorted(map(_key, merged), key=str) == sorted(map(_key, pairs), key=str)
+        if sort_distinct_pos:
+            score = distinct_pos_scorer(goals)
+            assert [score(p[1]) for p in merged] == sorted(score(p[1]) for p in pairs)
+        else:
+            assert [p[0] for p in merged] == sorted(p[0] for p in pairs)
+
+
+@pytest.mark.parametrize('filter', FILTERS)
+def test_vectorized_pairs_keep_order(filter):
+    props = _default_pair_props()
+    for goals in _goals(filter):
+        for goal1 in goals:
+            for goal2 in goals:
+                props.vectorized = False
+                pairs = [_key(p) for p in form_pairs(goal1, goal2, props)]
+                props.vectorized = True
+                assert [_key(p) for p in form_pairs(goal1, goal2, props)] == pairs
+
+
+@pytest.mark.parametrize('filter', FILTERS)
+def test_bit_goal_pairs_have_set_costs(filter):
+    props = _default_pair_props()
+    for goals in _goals(filter):
+        table = AtomTable(goals)
+        bit_goals = [BitGoal.from_atoms(goal, table) for goal in goals]
+        for i in range(len(goals)):
+            for j in range(i, len(goals)):
+                costs = [cost for cost, _ in form_pairs(goals[i], goals[j], props)]
+                assert [cost for cost, _ in form_pairs(bit_goals[i], bit_goals[j], props)] == costs
+
+
+@pytest.mark.parametrize('filter', FILTERS)
+def test_distinct_pos_scorer_matches_distinct_pos(filter):
+    props = _default_pair_props()
+    for goals in _goals(filter):
+        score = distinct_pos_scorer(goals)
+        table = AtomTable(goals)
+        bit_score = distinct_pos_scorer([BitGoal.from_atoms(goal, table) for goal in goals])
+        for _, (up, down) in generate_pairs(goals, props):
+            expected = distinct_pos(set.union(*goals).difference(up) | down)
+            assert score((up, down)) == expected
+            assert bit_score((BitGoal.from_atoms(up, table), BitGoal.from_atoms(down, table))) == expected
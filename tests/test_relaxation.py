@@ -0,0 +1,121 @@
+import random
+from itertools import chain, combinations
+import pytest
+import scamp_filter.MetaTransform as MetaTransform
+from scamp_filter.MetaProgrammer import AddMetaInstruction, MoveMetaIntstruction
+from scamp_filter.RegAlloc import get_liveness
+
+
+def decode(program):
+    return [MoveMetaIntstruction(*args) if kind == 'm' else AddMetaInstruction(*args) for kind, *args in program]
+
+
+def encode(meta_program):
+    return [('m', i.source, i.target, i.scale, tuple(i.shift), i.neg) if isinstance(i, MoveMetaIntstruction) else
+            ('+', i.source, i.source2, i.s1neg, i.s2neg, i.target) for i in meta_program]
+
+
+# meta programs, the number of registers and the result of relax_same_shift with the power set enumeration
+SAME_SHIFT_CASES = [
+    ([('m', 0, 1, 1, (0, 0), False), ('m', 1, 2, 0, (2, 0), False), ('m', 1, 3, 0, (3, 0), False),
+      ('+', 2, 3, False, False, 4), ('m', 1, 5, 0, (2, 1), False), ('+', 4, 5, False, False, 6),
+      ('+', 6, 1, False, False, 7)], 4,
+     [('m', 0, 1, 1, (0, 0), False), ('m', 1, 8, 0, (2, 0), False), ('m', 8, 3, 0, (1, 0), False),
+      ('+', 8, 3, False, False, 4), ('m', 8, 5, 0, (0, 1), False), ('+', 4, 5, False, False, 6),
+      ('+', 6, 1, False, False, 7)]),
+    ([('m', 0, 1, 2, (0, 0), False), ('m', 1, 2, 0, (1, 1), False), ('m', 1, 3, 0, (2, 1), False),
+      ('m', 1, 4, 1, (1, 2), False), ('+', 2, 3, False, False, 5), ('+', 5, 4, False, False, 6),
+      ('m', 6, 7, 0, (-1, 0), False), ('+', 6, 7, False, False, 8)], 4,
+     [('m', 0, 1, 2, (0, 0), False), ('m', 1, 9, 0, (1, 1), False), ('m', 9, 3, 0, (1, 0), False),
+      ('m', 9, 4, 1, (0, 1), False), ('+', 9, 3, False, False, 5), ('+', 5, 4, False, False, 6),
+      ('m', 6, 7, 0, (-1, 0), False), ('+', 6, 7, False, False, 8)]),
+    ([('m', 0, 1, 1, (0, 0), False), ('m', 1, 2, 0, (0, 2), False), ('m', 1, 3, 0, (1, 2), False),
+      ('m', 1, 4, 0, (-1, 2), False), ('m', 1, 5, 0, (0, 3), False), ('+', 2, 3, False, False, 6),
+      ('+', 4, 5, False, False, 7), ('+', 6, 7, False, False, 8), ('+', 8, 1, False, False, 9)], 4,
+     [('m', 0, 1, 1, (0, 0), False), ('m', 1, 10, 0, (0, 2), False), ('m', 10, 3, 0, (1, 0), False),
+      ('m', 1, 4, 0, (-1, 2), False), ('m', 1, 5, 0, (0, 3), False), ('+', 10, 3, False, False, 6),
+      ('+', 4, 5, False, False, 7), ('+', 6, 7, False, False, 8), ('+', 8, 1, False, False, 9)]),
+]
+
+# meta programs of searched plans, the number of registers and the result of relax_rebalance before the
+# incremental liveness
+REBALANCE_CASES = [
+    ([('m', 0, 1, 3, (0, 0), False), ('m', 1, 2, 0, (-1, 0), False), ('m', 2, 3, 0, (1, 0), False),
+      ('+', 1, 3, False, False, 4), ('m', 4, 5, 1, (0, -1), False), ('+', 2, 5, False, False, 6),
+      ('+', 4, 6, False, False, 7), ('m', 6, 8, 0, (1, 1), False), ('+', 7, 8, False, False, 9)], 2,
+     [('m', 0, 1, 3, (0, 0), False), ('+', 1, 1, False, False, 4), ('m', 4, 5, 1, (0, -1), False),
+      ('m', 1, 10, 0, (-1, 0), False), ('+', 10, 5, False, False, 6), ('+', 4, 6, False, False, 7),
+      ('m', 6, 8, 0, (1, 1), False), ('+', 7, 8, False, False, 9)]),
+    ([('m', 0, 1, 3, (1, 1), False), ('m', 1, 2, 0, (-1, 0), False), ('+', 1, 2, False, False, 3),
+      ('m', 2, 4, 0, (-1, 0), False), ('+', 3, 4, False, False, 5), ('m', 5, 6, 0, (0, -1), False),
+      ('+', 5, 6, False, False, 7), ('m', 6, 8, 0, (0, -1), False), ('+', 7, 8, False, False, 9)], 2,
+     [('m', 0, 1, 3, (0, 0), False), ('m', 1, 10, 0, (1, 0), False), ('+', 10, 1, False, False, 3),
+      ('m', 1, 4, 0, (-1, 0), False), ('+', 3, 4, False, False, 5), ('m', 5, 11, 0, (0, 1), False),
+      ('+', 11, 5, False, False, 7), ('m', 5, 8, 0, (0, -1), False), ('+', 7, 8, False, False, 9)]),
+]
+
+
+@pytest.mark.parametrize('program, n_reg, expected', SAME_SHIFT_CASES)
+def test_relax_same_shift_matches_power_set(program, n_reg, expected):
+    assert encode(MetaTransform.relax_same_shift(decode(program), n_reg)) == expected
+
+
+@pytest.mark.parametrize('program, n_reg, expected', REBALANCE_CASES)
+def test_relax_rebalance_unchanged(program, n_reg, expected):
+    assert encode(MetaTransform.relax_rebalance(decode(program), n_reg)) == expected
+
+
+def _random_fan_out(rng):
+    """A meta program with several shifts from the same register, whose results are summed up"""
+    meta_program = [MoveMetaIntstruction(0, 1, rng.randint(0, 2), (0, 0))]
+    regs, reg = [], 2
+    for _ in range(rng.randint(2, 7)):
+        meta_program.append(MoveMetaIntstruction(1, reg, rng.randint(-1, 1), (rng.randint(-2, 2), rng.randint(-2, 2))))
+        regs.append(reg)
+        reg += 1
+        if len(regs) > 1 and rng.random() < 0.5:
+            meta_program.append(AddMetaInstruction(regs.pop(), regs.pop(), False, False, reg))
+            regs.append(reg)
+            reg += 1
+    while len(regs) > 1:
+        meta_program.append(AddMetaInstruction(regs.pop(), regs.pop(), False, False, reg))
+        regs.append(reg)
+        reg += 1
+    return meta_program
+
+
+def _power_set_scores(meta_program, n_reg):
+    """Scores of the same shift candidates of the power set enumeration"""
+    liveness = get_liveness(meta_program)
+    reg_shifts, _, _ = MetaTransform.get_edges(meta_program)
+    scores = []
+    for addrs in reg_shifts.values():
+        for s in chain.from_iterable(combinations(addrs, r) for r in range(2, len(addrs)+1)):
+            if any(len(liveness[i]) >= n_reg for i in range(min(s), max(s)+1)):
+                continue
+            shift, scale = MetaTransform._common_shift(meta_program, s)
+            if shift != (0, 0) or scale != 0:
+                scores.append(len(s)*(abs(shift[0]) + abs(shift[1] + abs(scale))))
+    return scores
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_same_shift_candidates_find_best_power_set_score(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        meta_program = _random_fan_out(rng)
+        for n_reg in (2, 3, 4, 6):
+            candidates = MetaTransform.get_same_shift_candidates(meta_program, MetaTransform.get_edges(meta_program),
+                                                                 n_reg)
+            scores = [len(s)*(abs(shift[0]) + abs(shift[1] + abs(scale))) for _, shift, scale, s in candidates]
+            assert max(scores, default=None) == max(_power_set_scores(meta_program, n_reg), default=None)
+
+
+def test_ir_edges_and_liveness_follow_rewrites():
+    meta_program = _random_fan_out(random.Random(0))
+    ir = MetaTransform.MetaProgramIR(meta_program)
+    first = meta_program[1]
+    ir.insert(1, MoveMetaIntstruction(1, ir.new_reg(), 0, (1, 0)))
+    ir.replace(2, MoveMetaIntstruction(ir.max_reg, first.target, first.scale, first.shift, first.neg))
+    assert ir.edges == MetaTransform.get_edges(meta_program)
+    assert ir.live_counts() == [len(live) for live in get_liveness(meta_program)]
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from scamp_filter.scamp_filter import generate, _default_pair_props
+
+
+@pytest.mark.parametrize('heuristic_weight', [1, 2, 5])
+def test_best_first_finds_plan_for_random_filter(heuristic_weight):
+    filter = np.random.default_rng(0).random((3, 3))
+    pair_props = _default_pair_props()
+    pair_props.engine = 'best_first'
+    pair_props.heuristic_weight = heuristic_weight
+    program, program_length, sol_stats = generate(filter, None, verbose=0, approx_depth=4, pair_props=pair_props,
+                                                  max_expansions=500)
+    assert program_length > 0
+    assert sol_stats.best_cost() < float('inf')
+
+
+def test_beam_finds_plan_for_random_filter():
+    filter = np.random.default_rng(0).random((3, 3))
+    pair_props = _default_pair_props()
+    pair_props.engine = 'beam'
+    program, program_length, sol_stats = generate(filter, None, verbose=0, approx_depth=5, pair_props=pair_props,
+                                                  max_expansions=200)
+    assert program_length > 0
+    assert sol_stats.best_cost() < float('inf')